@@ -0,0 +1,695 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the annotation extraction in pdfannots.py.
+
+The pipeline benchmark generates a PDF with the given parameters, processes
+it one stage at a time, and prints a JSON record of the best time of each
+stage, so that runs on different commits can be compared. The startup
+benchmark likewise records the start-up and import time of pdfannots.py, the
+memory benchmark the peak memory use on documents of growing length, and the
+fonts benchmark the time per file of a batch of documents sharing a font.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import pdfminer
+from pdfminer.layout import LAParams, LTComponent
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+
+import pdfannots
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+MARKUP = ("Highlight", "Highlight", "Underline", "StrikeOut", "Squiggly")
+
+
+def synthetic_page(nglyphs, nannots, nboxes, seed=0):
+    """
+    Returns (glyphs, annots) for a single-column letter-sized page: nglyphs
+    5x10 glyphs laid out in lines, and nannots highlights each covering nboxes
+    consecutive lines of text.
+    """
+    rnd = random.Random(seed)
+    perline = 90
+    nlines = max(1, (nglyphs + perline - 1) // perline)
+    lineheight = min(12.0, 720.0 / nlines)
+
+    glyphs = []
+    for i in range(nglyphs):
+        (line, col) = divmod(i, perline)
+        x0 = 36 + col * 6
+        y0 = 756 - line * lineheight
+        glyphs.append(LTComponent((x0, y0, x0 + 5, y0 + 10)))
+
+    page = pdfannots.Page(0, (0, 0, 612, 792))
+    annots = []
+    for _ in range(nannots):
+        first = rnd.randrange(max(1, nlines - nboxes))
+        coords = []
+        for line in range(first, first + nboxes):
+            y0 = 756 - line * lineheight
+            x0 = 36 + rnd.randrange(perline // 2) * 6
+            x1 = x0 + rnd.randrange(10, perline // 2) * 6
+            coords += [x0, y0 + 10, x1, y0 + 10, x0, y0, x1, y0]
+        annots.append(pdfannots.Annotation(page, 'Highlight', coords))
+    return glyphs, annots
+
+
+def linear_testboxes(annots, item):
+    # reference implementation: test every box of every annotation
+    return frozenset({a for a in annots if any(
+        {pdfannots.boxhit(item, b) for b in a.getboxes()})})
+
+
+def bench_hittest(args):
+    """Cost of RectExtractor.testboxes as the number of annotations grows."""
+    if args.engine == "numpy":
+        return bench_glyphhits(args)
+    print("%8s %8s %12s %12s %8s" % (
+        "glyphs", "annots", "linear (s)", "indexed (s)", "speedup"))
+    for nannots in args.annots:
+        glyphs, annots = synthetic_page(args.glyphs, nannots, args.boxes)
+        extractor = pdfannots.device_class("python")(PDFResourceManager())
+        extractor.setannots(annots)
+        extractor._curline = set()
+
+        for g in glyphs:
+            assert linear_testboxes(annots, g) == extractor.testboxes(g)
+
+        linear = min(timeit.repeat(
+            lambda: [linear_testboxes(annots, g) for g in glyphs],
+            number=1, repeat=args.repeat))
+        indexed = min(timeit.repeat(
+            lambda: [extractor.testboxes(g) for g in glyphs],
+            number=1, repeat=args.repeat))
+        print("%8d %8d %12.4f %12.4f %7.1fx" % (
+            args.glyphs, nannots, linear, indexed, linear / indexed))
+
+
+def bench_glyphhits(args):
+    """
+    Cost of BatchRectExtractor.glyphhits against the Python engine's, after
+    checking that both find the same annotations for every glyph.
+    """
+    print("%8s %8s %12s %12s %8s" % (
+        "glyphs", "annots", "python (s)", "numpy (s)", "speedup"))
+    for nannots in args.annots:
+        glyphs, annots = synthetic_page(args.glyphs, nannots, args.boxes)
+        page = pdfannots.PageGlyphs()
+        for g in glyphs:
+            page.kinds.append(pdfannots.PageGlyphs.CHAR)
+            page.bboxes.extend(g.bbox)
+        (python, batch) = (
+            pdfannots.device_class(engine)(PDFResourceManager())
+            for engine in ("python", "numpy"))
+        python.setannots(annots)
+        batch.setannots(annots)
+
+        assert list(python.glyphhits(page)) == batch.glyphhits(page)
+
+        linear = min(timeit.repeat(
+            lambda: list(python.glyphhits(page)),
+            number=1, repeat=args.repeat))
+        batched = min(timeit.repeat(
+            lambda: batch.glyphhits(page),
+            number=1, repeat=args.repeat))
+        print("%8d %8d %12.4f %12.4f %7.1fx" % (
+            args.glyphs, nannots, linear, batched, linear / batched))
+
+
+def pdfstring(s):
+    return "(" + s.replace("\\", "\\\\").replace("(", "\\(").replace(
+        ")", "\\)") + ")"
+
+
+def embedded_font(newobj, objs):
+    """
+    Adds the objects of an embedded Type1 font to objs, and returns the font
+    dictionary. Its program is only a header and padding, but it carries the
+    encoding, and a ToUnicode CMap maps every code, as in subset fonts; both
+    must be parsed whenever the font is loaded. Every glyph is half an em
+    wide, like the average of Helvetica.
+    """
+    (descriptor, program, tounicode) = (newobj(), newobj(), newobj())
+    header = "%%!PS-AdobeFont-1.0: BENCH+Bench\n/Encoding 256 array\n" \
+        "0 1 255 {1 index exch /.notdef put} for\n%s\nreadonly def\n" \
+        "currentdict end\ncurrentfile eexec\n" % "\n".join(
+            "dup %d /g%d put" % (code, code) for code in range(256))
+    padding = "0" * 32768
+    objs[program] = "<< /Length %d /Length1 %d /Length2 %d /Length3 0 >>\n" \
+        "stream\n%s%s\nendstream" % (
+            len(header) + len(padding), len(header), len(padding), header,
+            padding)
+
+    cmap = "\n".join(
+        ["/CIDInit /ProcSet findresource begin 12 dict begin begincmap",
+         "/CMapName /Bench-UCS def 1 begincodespacerange <00> <FF> "
+         "endcodespacerange"] +
+        ["100 beginbfchar\n%s\nendbfchar" % "\n".join(
+            "<%02X> <%04X>" % (code, code)
+            for code in range(first, min(256, first + 100)))
+         for first in range(0, 256, 100)] +
+        ["endcmap CMapName currentdict /CMap defineresource pop end end"])
+    objs[tounicode] = "<< /Length %d >>\nstream\n%s\nendstream" % (
+        len(cmap), cmap)
+
+    objs[descriptor] = (
+        "<< /Type /FontDescriptor /FontName /BENCH+Bench /Flags 32 "
+        "/FontBBox [0 -200 1000 800] /ItalicAngle 0 /Ascent 800 "
+        "/Descent -200 /CapHeight 700 /StemV 80 /FontFile %d 0 R >>" % program)
+    return (
+        "<< /Type /Font /Subtype /Type1 /BaseFont /BENCH+Bench "
+        "/FirstChar 0 /LastChar 255 /Widths [%s] /FontDescriptor %d 0 R "
+        "/ToUnicode %d 0 R >>" % (" ".join(["500"] * 256), descriptor,
+                                  tounicode))
+
+
+def synthetic_pdf(pages=10, columns=2, lines=50, linechars=60, annots=10,
+                  boxes=2, sticky=0.2, outlines=4, depth=2, seed=0,
+                  embed=False):
+    """
+    Returns the bytes of a PDF with the given number of pages, each with
+    columns of lines of about linechars characters of Helvetica text, and
+    annots annotations, of which a fraction sticky are sticky notes and the
+    rest text markup spanning boxes lines. The outline tree has outlines
+    top-level entries and depth levels, each entry having two children. If
+    embed is set, the text is set in the font of embedded_font() instead.
+    """
+    rnd = random.Random(seed)
+    (width, height) = (612, 792)
+    colwidth = (width - 72) / columns
+    lineheight = (height - 72) / lines
+    objs = {}
+
+    def newobj():
+        objs[len(objs) + 1] = None
+        return len(objs)
+
+    (catalog, pagetree, info, font) = (newobj(), newobj(), newobj(), newobj())
+    if embed:
+        objs[font] = embedded_font(newobj, objs)
+    else:
+        objs[font] = "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+
+    pageids = []
+    for pageno in range(pages):
+        (pageid, streamid) = (newobj(), newobj())
+        pageids.append(pageid)
+
+        ops = ["BT /F1 %.1f Tf" % min(10, lineheight * 0.8)]
+        linepos = []
+        for col in range(columns):
+            x = 36 + col * colwidth
+            for line in range(lines):
+                y = height - 36 - (line + 1) * lineheight
+                text = ""
+                while len(text) < linechars:
+                    text += rnd.choice(WORDS) + " "
+                text = text[:linechars].strip()
+                ops.append("1 0 0 1 %.1f %.1f Tm %s Tj" % (
+                    x, y, pdfstring(text)))
+                # Helvetica averages about half an em per character
+                linepos.append((x, y, x + len(text) * 5))
+        ops.append("ET")
+        stream = "\n".join(ops)
+        objs[streamid] = "<< /Length %d >>\nstream\n%s\nendstream" % (
+            len(stream), stream)
+
+        annotids = []
+        for i in range(annots):
+            annotid = newobj()
+            annotids.append(annotid)
+            if rnd.random() < sticky:
+                (x, y) = (rnd.randrange(36, width - 56),
+                          rnd.randrange(36, height - 56))
+                objs[annotid] = (
+                    "<< /Type /Annot /Subtype /Text /Rect [%d %d %d %d] "
+                    "/Contents %s /T (benchmark) >>" % (
+                        x, y, x + 20, y + 20,
+                        pdfstring("sticky note %d on page %d" % (i, pageno))))
+                continue
+
+            first = rnd.randrange(max(1, len(linepos) - boxes))
+            spans = linepos[first:first + boxes]
+            quadpoints = []
+            for (x0, y, x1) in spans:
+                quadpoints += [x0, y + 9, x1, y + 9, x0, y - 2, x1, y - 2]
+            contents = ""
+            if rnd.random() < 0.3:
+                contents = " /Contents %s" % pdfstring(
+                    "comment %d on page %d" % (i, pageno))
+            objs[annotid] = (
+                "<< /Type /Annot /Subtype /%s /Rect [%.1f %.1f %.1f %.1f] "
+                "/QuadPoints [%s] /T (benchmark)%s >>" % (
+                    rnd.choice(MARKUP),
+                    min(s[0] for s in spans), spans[-1][1] - 2,
+                    max(s[2] for s in spans), spans[0][1] + 9,
+                    " ".join("%.1f" % v for v in quadpoints), contents))
+
+        annotrefs = ""
+        if annotids:
+            annotrefs = " /Annots [%s]" % " ".join(
+                "%d 0 R" % a for a in annotids)
+        objs[pageid] = (
+            "<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d] "
+            "/Contents %d 0 R /Resources << /Font << /F1 %d 0 R >> >>%s >>" % (
+                pagetree, width, height, streamid, font, annotrefs))
+
+    objs[pagetree] = "<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        " ".join("%d 0 R" % p for p in pageids), pages)
+
+    # outline entries are spread evenly through the document, in order
+    nentries = sum(outlines * 2 ** level for level in range(depth))
+    counter = iter(range(nentries))
+
+    def outline_level(parent, count, level, prefix):
+        ids = [newobj() for _ in range(count)]
+        for (i, outlineid) in enumerate(ids):
+            n = next(counter)
+            (pageno, y) = divmod(n * pages * 4 // max(1, nentries), 4)
+            entry = ["/Title %s" % pdfstring("%s%d" % (prefix, i + 1)),
+                     "/Parent %d 0 R" % parent,
+                     "/Dest [%d 0 R /XYZ 36 %d 0]" % (
+                         pageids[pageno], height - 36 - y * height // 4)]
+            if i > 0:
+                entry.append("/Prev %d 0 R" % ids[i - 1])
+            if i + 1 < count:
+                entry.append("/Next %d 0 R" % ids[i + 1])
+            if level + 1 < depth:
+                (first, last) = outline_level(
+                    outlineid, 2, level + 1, "%s%d." % (prefix, i + 1))
+                entry.append("/First %d 0 R /Last %d 0 R /Count 2" % (
+                    first, last))
+            objs[outlineid] = "<< %s >>" % " ".join(entry)
+        return ids[0], ids[-1]
+
+    outlinerefs = ""
+    if outlines and depth:
+        root = newobj()
+        (first, last) = outline_level(root, outlines, 0, "Section ")
+        objs[root] = "<< /Type /Outlines /First %d 0 R /Last %d 0 R " \
+            "/Count %d >>" % (first, last, outlines)
+        outlinerefs = " /Outlines %d 0 R" % root
+
+    objs[catalog] = "<< /Type /Catalog /Pages %d 0 R%s >>" % (
+        pagetree, outlinerefs)
+    objs[info] = "<< /Title (Benchmark document) /Author (benchmark.py) >>"
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for objid in range(1, len(objs) + 1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (
+            objid, objs[objid].encode("latin-1")))
+    startxref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objs) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R >>\n"
+              b"startxref\n%d\n%%%%EOF\n" % (
+                  len(objs) + 1, catalog, info, startxref))
+    return out.getvalue()
+
+
+class LayoutRecorder(pdfannots.device_class("python")):
+    """Keeps each page's flattened layout, without hit-testing it."""
+
+    def receive_layout(self, ltpage):
+        self.glyphs = pdfannots.PageGlyphs.from_layout(ltpage)
+
+
+def run_pipeline(data, engine, columns):
+    """
+    Processes the PDF in data the way pdfannots.py does, but one stage at a
+    time. Returns (stage timings in seconds, counts).
+    """
+    timings = dict.fromkeys(
+        ("parse", "interpret", "hittest", "sort", "outlines", "render"), 0.0)
+    counts = dict.fromkeys(("pages", "glyphs", "annots", "boxes"), 0)
+
+    def timed(stage, fn, *args, **kwargs):
+        t = time.perf_counter()
+        result = fn(*args, **kwargs)
+        timings[stage] += time.perf_counter() - t
+        return result
+
+    def parse():
+        doc = PDFDocument(PDFParser(io.BytesIO(data)))
+        pages = []
+        for (pageno, pdfpage) in enumerate(PDFPage.create_pages(doc)):
+            page = pdfannots.Page(pageno, pdfpage.mediabox)
+            annots = pdfannots.getannots(
+                pdfannots.getpdfannots(pdfpage), page, columns)
+            pages.append((page, pdfpage, annots))
+        return doc, pages
+
+    (doc, pages) = timed("parse", parse)
+    counts["pages"] = len(pages)
+
+    rsrcmgr = PDFResourceManager()
+    recorder = LayoutRecorder(rsrcmgr, laparams=LAParams())
+    interpreter = PDFPageInterpreter(rsrcmgr, recorder)
+    device = pdfannots.device_class(engine)(rsrcmgr, laparams=LAParams())
+
+    allannots = []
+    for (page, pdfpage, annots) in pages:
+        counts["annots"] += len(annots)
+        counts["boxes"] += sum(len(a.boxes or ()) // 4 for a in annots)
+        if not any(a.boxes for a in annots):
+            allannots.extend(annots)
+            continue
+        timed("interpret", interpreter.process_page, pdfpage)
+        counts["glyphs"] += len(recorder.glyphs.kinds)
+        device.setannots(annots)
+        timed("hittest", device.receive_glyphs, recorder.glyphs)
+        allannots.extend(annots)
+    recorder.close()
+    device.close()
+
+    timed("sort", allannots.sort, key=lambda a: a.key)
+    pageslist = [page for (page, _, _) in pages]
+    pagesdict = {pdfpage.pageid: page for (page, pdfpage, _) in pages}
+    outlines = timed("outlines", pdfannots.get_outlines,
+                     doc, pageslist, pagesdict, columns)
+
+    def render():
+        printer = pdfannots.OrgPrinter(pdfannots.OutlineIndex(outlines), None,
+                                       io.StringIO())
+        printer.printall_grouped(["highlights", "comments", "nits"],
+                                 allannots)
+    timed("render", render)
+    return timings, counts
+
+
+def git_commit():
+    """Returns the commit of the working tree, if it is a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_pipeline(args):
+    """Best time of each stage over args.repeat runs, as a JSON record."""
+    params = dict(pages=args.pages, columns=args.columns, lines=args.lines,
+                  linechars=args.linechars, annots=args.annots_per_page,
+                  boxes=args.boxes, sticky=args.sticky,
+                  outlines=args.outlines, depth=args.depth, seed=args.seed)
+    data = synthetic_pdf(**params)
+    if args.save:
+        with open(args.save, "wb") as f:
+            f.write(data)
+
+    best = None
+    for _ in range(args.repeat):
+        (timings, counts) = run_pipeline(data, args.engine, args.columns)
+        if best is None:
+            best = timings
+        else:
+            best = {k: min(v, timings[k]) for (k, v) in best.items()}
+
+    emit_record(args, {
+        "benchmark": "pipeline",
+        "engine": args.engine,
+        "params": params,
+        "counts": counts,
+        "seconds": {k: round(v, 6) for (k, v) in best.items()},
+        "total": round(sum(best.values()), 6),
+    })
+
+
+def run_importtime(argv, cwd):
+    """
+    Runs pdfannots.py with the given arguments under python -X importtime.
+    Returns (wall time, total import time, [(import time, module)] for each
+    top-level import), in seconds.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "pdfannots.py")
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", script] + argv,
+                          cwd=cwd, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, text=True)
+    wall = time.perf_counter() - start
+
+    # lines are "import time: self [us] | cumulative | name", with the name
+    # indented by nesting depth
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        (_, cumulative, name) = line.split("|")
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            imports.append((int(cumulative) / 1e6, name.strip()))
+    return wall, sum(t for (t, _) in imports), imports
+
+
+def bench_startup(args):
+    """Start-up cost for --help and for a document without annotations."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        pdfpath = os.path.join(tmpdir, "empty.pdf")
+        with open(pdfpath, "wb") as f:
+            f.write(synthetic_pdf(pages=1, annots=0, outlines=0))
+
+        cases = {}
+        for (name, argv) in (("help", ["--help"]), ("noannots", [pdfpath])):
+            runs = [run_importtime(argv, tmpdir) for _ in range(args.repeat)]
+            (wall, imports, modules) = min(runs)
+            cases[name] = {
+                "wall": round(wall, 6),
+                "imports": round(imports, 6),
+                "slowest": [[m, round(t, 6)] for (t, m) in
+                            sorted(modules, reverse=True)[:args.top]],
+            }
+
+    emit_record(args, {"benchmark": "startup", "cases": cases})
+
+
+def run_stats(argv, cwd):
+    """
+    Runs pdfannots.py with the given arguments and --stats. Returns the last
+    record written, which covers the whole of the last file.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "pdfannots.py")
+    statsfile = os.path.join(cwd, "stats.jsonl")
+    subprocess.run([sys.executable, script, "--stats", statsfile] + argv,
+                   cwd=cwd, check=True)
+    with open(statsfile) as f:
+        record = json.loads(f.readlines()[-1])
+    os.unlink(statsfile)
+    return record
+
+
+def bench_memory(args):
+    """
+    Peak memory use as the number of pages grows, with and without
+    --max-memory. Fails if the peak with --max-memory grows by more than
+    args.tolerance percent from the smallest document to the largest.
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for pages in sorted(args.pages):
+            pdfpath = os.path.join(tmpdir, "doc%d.pdf" % pages)
+            with open(pdfpath, "wb") as f:
+                f.write(synthetic_pdf(pages=pages, lines=args.lines,
+                                      annots=args.annots_per_page, sticky=0))
+            for limit in (None, args.max_memory):
+                argv = [pdfpath]
+                if limit:
+                    argv = ["--max-memory", str(limit)] + argv
+                record = run_stats(argv, tmpdir)
+                results.append({"pages": pages, "max_memory": limit,
+                                "peak_rss_kb": record["peak_rss_kb"],
+                                "trims": record["trims"],
+                                "wall": record["wall"]})
+
+    bounded = [r["peak_rss_kb"] for r in results if r["max_memory"]]
+    growth = 100.0 * (bounded[-1] - bounded[0]) / bounded[0]
+    emit_record(args, {"benchmark": "memory", "results": results,
+                       "growth_percent": round(growth, 1)})
+    if growth > args.tolerance:
+        sys.stderr.write("peak memory grew by %.1f%% with --max-memory %d\n"
+                         % (growth, args.max_memory))
+        return 1
+    return 0
+
+
+def bench_fonts(args):
+    """
+    Time per file to extract a batch of documents that share an embedded
+    font, with fonts loaded afresh for each file and kept across files.
+    """
+    docs = [synthetic_pdf(pages=args.pages, lines=args.lines,
+                          annots=args.annots_per_page, seed=seed, embed=True)
+            for seed in range(args.files)]
+    fonts = pdfannots.shared_fonts()
+
+    def run(shared):
+        fonts.clear()
+        start = time.perf_counter()
+        for data in docs:
+            if not shared:
+                fonts.clear()
+            pdfannots.process_file(io.BytesIO(data), False, args.engine)
+        return (time.perf_counter() - start) / len(docs)
+
+    fresh = min(run(False) for _ in range(args.repeat))
+    shared = min(run(True) for _ in range(args.repeat))
+    emit_record(args, {
+        "benchmark": "fonts",
+        "engine": args.engine,
+        "files": args.files,
+        "pages": args.pages,
+        "seconds_per_file": {"fresh": round(fresh, 6),
+                             "shared": round(shared, 6)},
+        "speedup": round(fresh / shared, 2),
+    })
+
+
+def emit_record(args, record):
+    """Prints a JSON result, and appends it to args.output if set."""
+    record.update(commit=git_commit(), python=platform.python_version(),
+                  pdfminer=pdfminer.__version__)
+    line = json.dumps(record, sort_keys=True)
+    print(line)
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(line + "\n")
+
+
+def parse_args():
+    p = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = p.add_subparsers(dest="benchmark", required=True)
+
+    h = sub.add_parser("hittest", help="time hit-testing of glyphs")
+    h.set_defaults(func=bench_hittest)
+    h.add_argument("--glyphs", type=int, default=5000,
+                   help="glyphs per page (default: 5000)")
+    h.add_argument("--annots", type=int, nargs="+",
+                   default=[1, 10, 50, 200],
+                   help="annotation counts to measure (default: 1 10 50 200)")
+    h.add_argument("--boxes", type=int, default=3,
+                   help="boxes per annotation (default: 3)")
+    h.add_argument("--repeat", type=int, default=3,
+                   help="take the best of this many runs (default: 3)")
+    h.add_argument("--engine", choices=sorted(pdfannots.EXTRACTORS),
+                   default="python",
+                   help="with numpy, compare the hits and time of the numpy "
+                   "engine with the python engine's, rather than the "
+                   "indexed hit-test with a linear one (default: python)")
+
+    g = sub.add_parser(
+        "pipeline", help="time each stage on a generated document")
+    g.set_defaults(func=bench_pipeline)
+    g.add_argument("--pages", type=int, default=20,
+                   help="number of pages (default: 20)")
+    g.add_argument("--columns", type=int, default=2,
+                   help="text columns per page (default: 2)")
+    g.add_argument("--lines", type=int, default=50,
+                   help="lines per column (default: 50)")
+    g.add_argument("--linechars", type=int, default=50,
+                   help="characters per line (default: 50)")
+    g.add_argument("--annots-per-page", type=int, default=10,
+                   help="annotations per page (default: 10)")
+    g.add_argument("--boxes", type=int, default=2,
+                   help="lines spanned by each text markup (default: 2)")
+    g.add_argument("--sticky", type=float, default=0.2,
+                   help="fraction of annotations that are sticky notes "
+                   "(default: 0.2)")
+    g.add_argument("--outlines", type=int, default=4,
+                   help="top-level outline entries (default: 4)")
+    g.add_argument("--depth", type=int, default=2,
+                   help="levels of the outline tree (default: 2)")
+    g.add_argument("--seed", type=int, default=0,
+                   help="random seed for the generator (default: 0)")
+    g.add_argument("--engine", choices=sorted(pdfannots.EXTRACTORS),
+                   default="python", help="hit-testing engine to measure")
+    g.add_argument("--repeat", type=int, default=3,
+                   help="take the best of this many runs (default: 3)")
+    g.add_argument("--output", metavar="FILE",
+                   help="also append the JSON record to FILE")
+    g.add_argument("--save", metavar="PDF",
+                   help="save the generated document to PDF")
+
+    s = sub.add_parser(
+        "startup", help="time start-up and imports of pdfannots.py")
+    s.set_defaults(func=bench_startup)
+    s.add_argument("--repeat", type=int, default=5,
+                   help="take the best of this many runs (default: 5)")
+    s.add_argument("--top", type=int, default=5,
+                   help="list this many of the slowest imports (default: 5)")
+    s.add_argument("--output", metavar="FILE",
+                   help="also append the JSON record to FILE")
+
+    m = sub.add_parser(
+        "memory", help="check that --max-memory bounds peak memory")
+    m.set_defaults(func=bench_memory)
+    m.add_argument("--pages", type=int, nargs="+", default=[100, 400, 1600],
+                   help="page counts to measure (default: 100 400 1600)")
+    m.add_argument("--lines", type=int, default=8,
+                   help="lines per column (default: 8)")
+    m.add_argument("--annots-per-page", type=int, default=1,
+                   help="annotations per page (default: 1)")
+    m.add_argument("--max-memory", type=int, default=1, metavar="MB",
+                   help="limit to run with; the default of 1 is always "
+                   "exceeded, so caches are dropped after every page")
+    m.add_argument("--tolerance", type=float, default=10, metavar="PERCENT",
+                   help="allowed growth of peak memory with the limit "
+                   "(default: 10)")
+    m.add_argument("--output", metavar="FILE",
+                   help="also append the JSON record to FILE")
+
+    f = sub.add_parser(
+        "fonts", help="time a batch of documents sharing an embedded font")
+    f.set_defaults(func=bench_fonts)
+    f.add_argument("--files", type=int, default=20,
+                   help="number of documents (default: 20)")
+    f.add_argument("--pages", type=int, default=2,
+                   help="pages per document (default: 2)")
+    f.add_argument("--lines", type=int, default=20,
+                   help="lines per column (default: 20)")
+    f.add_argument("--annots-per-page", type=int, default=2,
+                   help="annotations per page (default: 2)")
+    f.add_argument("--engine", choices=sorted(pdfannots.EXTRACTORS),
+                   default="python", help="hit-testing engine to use")
+    f.add_argument("--repeat", type=int, default=3,
+                   help="take the best of this many runs (default: 3)")
+    f.add_argument("--output", metavar="FILE",
+                   help="also append the JSON record to FILE")
+
+    args = p.parse_args()
+    if getattr(args, "engine", None) == "numpy" and not pdfannots.have_numpy():
+        p.error("the numpy engine requires NumPy")
+    return args
+
+
+def main():
+    args = parse_args()
+    return args.func(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,25 +6,37 @@ Extracts annotations from a PDF file in markdown format for use in reviewing.
 """
 
 import argparse
+import bisect
+import contextlib
+import hashlib
+import importlib.util
 import io
+import json
+import marshal
+import math
+import mmap
+import queue
+import signal
+import socketserver
 import sys
 import os
+import tempfile
+import itertools
 import textwrap
-from collections import defaultdict
-from PyPDF2 import PdfFileReader
-
-import pdfminer.pdftypes as pdftypes
-import pdfminer.settings
-import pdfminer.utils
-from pdfminer.converter import TextConverter
-from pdfminer.layout import LAParams, LTContainer, LTAnno, LTChar, LTTextBox
-from pdfminer.pdfdocument import PDFDocument, PDFNoOutlines
-from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
-from pdfminer.pdfpage import PDFPage
-from pdfminer.pdfparser import PDFParser
-from pdfminer.psparser import PSLiteralTable, PSLiteral
-
-pdfminer.settings.STRICT = False
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict, defaultdict
+
+# pdfminer, NumPy and the parallel processing modules are slow to import, so
+# they are only imported once needed, and --help and argument errors are
+# quick; see LazyPackage
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 SUBSTITUTIONS = {
     u'ﬀ': 'ff',
@@ -42,11 +54,43 @@ SUBSTITUTIONS = {
 ANNOT_SUBTYPES = frozenset(
     {'Text', 'Highlight', 'Squiggly', 'StrikeOut', 'Underline'})
 
-COLUMNS_PER_PAGE = 2  # default only, changed via a command-line parameter
+NIT_SUBTYPES = frozenset({'Squiggly', 'StrikeOut', 'Underline'})
+
+COLUMNS_PER_PAGE = 2  # default only, set per document by a parameter
 
 DEBUG_BOXHIT = False
 
 
+class LazyPackage:
+    """
+    Stands in for a package that is slow to import: each of its modules is
+    imported when first used as an attribute, as in pdfminer.layout.LTChar.
+    """
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, module):
+        if module.startswith('_'):
+            raise AttributeError(module)
+        value = importlib.import_module('%s.%s' % (self._name, module))
+        setattr(self, module, value)
+        return value
+
+
+pdfminer = LazyPackage('pdfminer')
+
+
+def have_numpy():
+    """Is NumPy available for the numpy engine?"""
+    return importlib.util.find_spec('numpy') is not None
+
+
+def have_pyarrow():
+    """Is PyArrow available for Parquet output?"""
+    return importlib.util.find_spec('pyarrow') is not None
+
+
 def boxhit(item, box):
     (x0, y0, x1, y1) = box
     assert item.x0 <= item.x1 and item.y0 <= item.y1
@@ -82,30 +126,175 @@ def boxhit(item, box):
         return overlap_area >= 0.5 * item_area
 
 
-class RectExtractor(TextConverter):
-    def __init__(self, rsrcmgr, codec='utf-8', pageno=1, laparams=None):
+class BoxIndex:
+    """
+    Uniform grid of horizontal bands over a page, mapping each band to the
+    annotation boxes that intersect it, so that an item need only be tested
+    against the boxes sharing one of its bands.
+    """
+
+    BAND_HEIGHT = 8  # in PDF units; roughly a line of body text
+
+    # boxes spanning more bands than this (far more than a page) are kept
+    # apart and tested against every item, rather than entered in each band
+    MAX_BANDS = 1024
+
+    def __init__(self, annots, margin=0):
+        """
+        margin  If non-zero, index the boxes inflated by this much on each side
+        """
+        self.bands = defaultdict(list)
+        self.tall = []  # (annot, box) of the boxes too tall to band
+        for a in annots:
+            for (x0, y0, x1, y1) in a.getboxes():
+                box = (x0 - margin, y0 - margin, x1 + margin, y1 + margin)
+                if box[3] - box[1] > self.MAX_BANDS * self.BAND_HEIGHT:
+                    self.tall.append((a, box))
+                    continue
+                for band in self._bands(box[1], box[3]):
+                    self.bands[band].append((a, box))
+        # range of the bands in use, to which items' bands are clipped
+        (self.lo, self.hi) = ((min(self.bands), max(self.bands))
+                              if self.bands else (0, -1))
+
+    def _bands(self, y0, y1):
+        return range(math.floor(y0 / self.BAND_HEIGHT),
+                     math.floor(y1 / self.BAND_HEIGHT) + 1)
+
+    def _itemboxes(self, item):
+        """Yields the (annot, box) of the tall boxes and the item's bands."""
+        yield from self.tall
+        lo = max(self.lo, math.floor(item.y0 / self.BAND_HEIGHT))
+        hi = min(self.hi, math.floor(item.y1 / self.BAND_HEIGHT))
+        for band in range(lo, hi + 1):
+            yield from self.bands.get(band, ())
+
+    def candidates(self, item):
+        # boxhit requires a non-zero overlap, hence a common y-coordinate and
+        # a common band, so any box not found here cannot be hit
+        return set(self._itemboxes(item))
+
+    def touches(self, item):
+        """Does the item intersect any of the boxes?"""
+        for (_, (x0, y0, x1, y1)) in self._itemboxes(item):
+            if (item.x0 <= x1 and x0 <= item.x1 and
+                    item.y0 <= y1 and y0 <= item.y1):
+                return True
+        return False
+
+    def meets_rows(self, item):
+        """Does the item share a y-coordinate with any of the boxes?"""
+        for (_, (_, y0, _, y1)) in self._itemboxes(item):
+            if item.y0 <= y1 and y0 <= item.y1:
+                return True
+        return False
+
+
+class RectExtractor:
+    """
+    Captures the text covered by annotation boxes as pages are laid out.
+    This is the logic of a pdfminer TextConverter device, which device_class()
+    defines on first use, so that pdfminer need not be imported beforehand.
+    """
+
+    # how far above and below the annotation boxes characters are kept in
+    # restrict mode
+    RESTRICT_MARGIN = 40
+
+    def __init__(self, rsrcmgr, codec='utf-8', pageno=1, laparams=None,
+                 restrict=False):
+        """
+        restrict  If True, discard characters away from the annotation boxes
+                  before layout analysis, rather than analysing the full page
+        """
         dummy = io.StringIO()
-        TextConverter.__init__(
-            self,
+        super().__init__(
             rsrcmgr,
             outfp=dummy,
             codec=codec,
             pageno=pageno,
             laparams=laparams)
+        self.restrict = restrict
+        self.restricting = False  # if set, restrict the current page
+        self.keepglyphs = False  # if set, keep each page's PageGlyphs
+        self.glyphs = None
+        self.stats = None  # if set, counters of the current page for --stats
         self.annots = set()
+        self.index = BoxIndex(())
+        self.nearindex = BoxIndex(())
 
     def setannots(self, annots):
         self.annots = {a for a in annots if a.boxes}
+        self.index = BoxIndex(self.annots)
+        # the order of text boxes depends on the whole page, so a page with
+        # an annotation whose text leads back up the page (e.g. to the next
+        # column) is analysed in full
+        self.restricting = self.restrict and not any(
+            top > prevtop
+            for a in self.annots
+            for ((_, _, _, prevtop), (_, _, _, top))
+            in zip(a.getboxes(), itertools.islice(a.getboxes(), 1, None)))
+        if self.restricting:
+            self.nearindex = BoxIndex(self.annots, self.RESTRICT_MARGIN)
+
+    def end_page(self, page):
+        # Layout analysis (grouping characters into lines and text boxes) is
+        # costly on busy pages, so in restrict mode we only let it see the
+        # characters in the rows of the page near an annotation. Rows are
+        # kept across the full width of the page, so that lines are whole,
+        # and the margin keeps enough lines above and below for text boxes
+        # to be delimited as they would be on the full page.
+        if self.restricting:
+            self.cur_item._objs = [
+                obj for obj in self.cur_item
+                if not isinstance(obj, pdfminer.layout.LTChar)
+                or self.nearindex.meets_rows(obj)]
+        super().end_page(page)
 
     # main callback from parent PDFConverter
     def receive_layout(self, ltpage):
+        # with --stats, pages are flattened so that hit-testing can be timed
+        # separately from layout analysis
+        if self.keepglyphs or self.stats is not None:
+            self.glyphs = PageGlyphs.from_layout(ltpage)
+            self.receive_glyphs(self.glyphs)
+        else:
+            self._lasthit = frozenset()
+            self._curline = set()
+            self.render(ltpage)
+            self.finalize()
+
+    def receive_glyphs(self, glyphs):
+        """
+        Equivalent of receive_layout() for a page flattened to PageGlyphs.
+        """
+        start = time.perf_counter()
         self._lasthit = frozenset()
         self._curline = set()
-        self.render(ltpage)
+        self.replay(glyphs, self.glyphhits(glyphs))
+        self.finalize()
+        if self.stats is not None:
+            self.stats['glyphs'] += glyphs.kinds.count(PageGlyphs.CHAR)
+            self.stats['hittest'] += time.perf_counter() - start
+
+    def finalize(self):
+        for a in self.annots:
+            a.finalize()
+
+    def hittest(self, item):
+        candidates = self.index.candidates(item)
+        if self.stats is not None:
+            self.stats['boxhits'] += len(candidates)
+        return frozenset({a for (a, b) in candidates if boxhit(item, b)})
+
+    def glyphhits(self, glyphs):
+        """Yields the annotations hit by each CHAR and TEXTBOX of glyphs."""
+        bboxes = glyphs.bboxes
+        for i in range(0, len(bboxes), 4):
+            yield self.hittest(pdfminer.layout.LTComponent(bboxes[i:i + 4]))
 
     def testboxes(self, item):
-        hits = frozenset({a for a in self.annots if any(
-            {boxhit(item, b) for b in a.boxes})})
+        hits = self.hittest(item)
         self._lasthit = hits
         self._curline.update(hits)
         return hits
@@ -120,27 +309,27 @@ class RectExtractor(TextConverter):
 
     def render(self, item):
         # If it's a container, recurse on nested items.
-        if isinstance(item, LTContainer):
+        if isinstance(item, pdfminer.layout.LTContainer):
             for child in item:
                 self.render(child)
 
             # Text boxes are a subclass of container, and somehow encode newlines
             # (this weird logic is derived from pdfminer.converter.TextConverter)
-            if isinstance(item, LTTextBox):
+            if isinstance(item, pdfminer.layout.LTTextBox):
                 self.testboxes(item)
                 self.capture_newline()
 
         # Each character is represented by one LTChar, and we must handle
         # individual characters (not higher-level objects like LTTextLine)
         # so that we can capture only those covered by the annotation boxes.
-        elif isinstance(item, LTChar):
+        elif isinstance(item, pdfminer.layout.LTChar):
             for a in self.testboxes(item):
                 a.capture(item.get_text())
 
         # Annotations capture whitespace not explicitly encoded in
         # the text. They don't have an (X,Y) position, so we need some
         # heuristics to match them to the nearby annotations.
-        elif isinstance(item, LTAnno):
+        elif isinstance(item, pdfminer.layout.LTAnno):
             text = item.get_text()
             if text == '\n':
                 self.capture_newline()
@@ -148,12 +337,274 @@ class RectExtractor(TextConverter):
                 for a in self._lasthit:
                     a.capture(text)
 
+    def replay(self, glyphs, hits):
+        """
+        Equivalent of render() for a flattened page, where hits yields the
+        annotations hit by each CHAR and TEXTBOX of glyphs, in order.
+        """
+        hits = iter(hits)
+        texts = iter(glyphs.texts)
+        for kind in glyphs.kinds:
+            if kind == PageGlyphs.CHAR:
+                self._lasthit = next(hits)
+                self._curline.update(self._lasthit)
+                text = next(texts)
+                for a in self._lasthit:
+                    a.capture(text)
+            elif kind == PageGlyphs.TEXTBOX:
+                self._lasthit = next(hits)
+                self._curline.update(self._lasthit)
+                self.capture_newline()
+            else:
+                text = next(texts)
+                if text == '\n':
+                    self.capture_newline()
+                else:
+                    for a in self._lasthit:
+                        a.capture(text)
+
+
+class BatchRectExtractor(RectExtractor):
+    """
+    RectExtractor that flattens each page into PageGlyphs and hit-tests all of
+    its characters against all annotation boxes at once using NumPy.
+    """
+
+    # maximum number of item-box pairs tested at once, which bounds the size
+    # of the temporary arrays (each holds one double per pair)
+    BATCH_PAIRS = 1 << 18
+
+    def receive_layout(self, ltpage):
+        self.glyphs = PageGlyphs.from_layout(ltpage)
+        self.receive_glyphs(self.glyphs)
+
+    def glyphhits(self, glyphs):
+        import numpy
+
+        owners = []
+        boxes = array('d')
+        for a in self.annots:
+            owners.extend([a] * (len(a.boxes) // 4))
+            boxes.extend(a.boxes)
+
+        nitems = len(glyphs.bboxes) // 4
+        hits = [frozenset()] * nitems
+        if self.stats is not None:
+            self.stats['boxhits'] += nitems * (len(boxes) // 4)
+        if not boxes or not nitems:
+            return hits
+
+        # the boxhit() overlap test, for every item against every box, on
+        # as many items at a time as keeps within BATCH_PAIRS
+        items = numpy.frombuffer(glyphs.bboxes, dtype=float).reshape(-1, 4)
+        (bx0, by0, bx1, by1) = numpy.frombuffer(
+            boxes, dtype=float).reshape(-1, 4).T
+        step = max(1, self.BATCH_PAIRS // len(bx0))
+        rowhits = defaultdict(set)
+        for start in range(0, nitems, step):
+            (ix0, iy0, ix1, iy1) = (items[start:start + step, i, None]
+                                    for i in range(4))
+            x_overlap = numpy.maximum(
+                0, numpy.minimum(ix1, bx1) - numpy.maximum(ix0, bx0))
+            y_overlap = numpy.maximum(
+                0, numpy.minimum(iy1, by1) - numpy.maximum(iy0, by0))
+            item_area = (ix1 - ix0) * (iy1 - iy0)
+            hit = ((x_overlap * y_overlap >= 0.5 * item_area)
+                   & (item_area != 0))
+            for (row, col) in zip(*numpy.nonzero(hit)):
+                rowhits[start + row].add(owners[col])
+        for (row, annots) in rowhits.items():
+            hits[row] = frozenset(annots)
+        return hits
+
+
+class PageGlyphs:
+    """
+    The text of a laid-out page flattened into the sequence of items that
+    RectExtractor.render() acts upon: characters, text boxes (whose end
+    marks a line break) and LTAnno whitespace.
+    """
+
+    CHAR, TEXTBOX, ANNO = range(3)
+
+    def __init__(self):
+        self.kinds = bytearray()
+        self.bboxes = array('d')  # x0, y0, x1, y1 of each CHAR and TEXTBOX
+        self.texts = []  # text of each CHAR and ANNO
+
+    @classmethod
+    def from_layout(cls, ltpage):
+        glyphs = cls()
+        glyphs.add(ltpage)
+        return glyphs
+
+    def add(self, item):
+        # mirrors the traversal in RectExtractor.render()
+        if isinstance(item, pdfminer.layout.LTContainer):
+            for child in item:
+                self.add(child)
+            if isinstance(item, pdfminer.layout.LTTextBox):
+                self.kinds.append(self.TEXTBOX)
+                self.bboxes.extend(item.bbox)
+        elif isinstance(item, pdfminer.layout.LTChar):
+            self.kinds.append(self.CHAR)
+            self.bboxes.extend(item.bbox)
+            self.texts.append(item.get_text())
+        elif isinstance(item, pdfminer.layout.LTAnno):
+            self.kinds.append(self.ANNO)
+            self.texts.append(item.get_text())
+
+    def dumps(self):
+        return zlib.compress(marshal.dumps(
+            (bytes(self.kinds), self.bboxes.tobytes(), self.texts)))
+
+    @classmethod
+    def loads(cls, data):
+        (kinds, bboxes, texts) = marshal.loads(zlib.decompress(data))
+        glyphs = cls()
+        glyphs.kinds.extend(kinds)
+        glyphs.bboxes.frombytes(bboxes)
+        glyphs.texts = texts
+        return glyphs
+
+
+def digest_object(obj, memo, h):
+    """
+    Feeds a canonical serialisation of a PDF object, and of everything it
+    references, into the hash h.
+
+    memo  Map from object ID to the digest of that object, for the document
+    """
+    if isinstance(obj, pdfminer.pdftypes.PDFObjRef):
+        if obj.objid not in memo:
+            memo[obj.objid] = None  # guards against reference cycles
+            objh = hashlib.sha256()
+            digest_object(obj.resolve(), memo, objh)
+            memo[obj.objid] = objh.digest()
+        h.update(b'R%r' % memo[obj.objid])
+    elif isinstance(obj, dict):
+        h.update(b'<<')
+        for k in sorted(obj):
+            h.update(b'/%r' % k)
+            digest_object(obj[k], memo, h)
+        h.update(b'>>')
+    elif isinstance(obj, list):
+        h.update(b'[')
+        for v in obj:
+            digest_object(v, memo, h)
+        h.update(b']')
+    elif isinstance(obj, pdfminer.pdftypes.PDFStream):
+        digest_object(obj.attrs, memo, h)
+        # decoded, since pdfminer drops the raw data once a stream is decoded
+        data = obj.get_data()
+        h.update(b'stream%d:' % len(data))
+        h.update(data)
+    elif isinstance(obj, pdfminer.psparser.PSLiteral):
+        h.update(b'/%r' % obj.name)
+    else:
+        h.update(b'%r' % obj)
+
+
+@contextlib.contextmanager
+def atomic_write(filename, mode='w', **kwargs):
+    """
+    Opens a temporary file alongside filename, with further arguments as for
+    open(), which replaces filename once closed without error, so that no
+    reader sees a partly written file.
+    """
+    tmpname = '%s.%d.tmp' % (filename, os.getpid())
+    f = open(tmpname, mode, **kwargs)  # if this fails, there is no file
+    try:
+        with f:
+            yield f
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+
+class GlyphCache:
+    """
+    On-disk cache of the PageGlyphs of each page, keyed by a digest of
+    everything that determines the page's layout, with LRU eviction once the
+    cache grows beyond maxsize bytes.
+    """
+
+    VERSION = 1  # bump whenever PageGlyphs or the layout parameters change
+
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        self.size = None  # computed on the first write
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, pdfpage, memo):
+        h = hashlib.sha256(b'pdfannots-glyphs-%d' % self.VERSION)
+        digest_object([pdfpage.mediabox, pdfpage.cropbox, pdfpage.rotate,
+                       pdfpage.resources, pdfpage.contents], memo, h)
+        return h.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                glyphs = PageGlyphs.loads(f.read())
+            os.utime(filename)  # the mtime orders entries for eviction
+            return glyphs
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, EOFError, TypeError, zlib.error) as ex:
+            sys.stderr.write("Warning: ignoring bad cache entry %s: %s\n" %
+                             (filename, ex))
+            return None
+
+    def put(self, key, glyphs):
+        filename = self._filename(key)
+        data = glyphs.dumps()
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with atomic_write(filename, 'wb') as f:
+            f.write(data)
+
+        if self.size is None:
+            self.size = sum(size for (_, _, size) in self._entries())
+        else:
+            self.size += len(data)
+        if self.size > self.maxsize:
+            self.evict()
+
+    def _entries(self):
+        for (dirpath, _, filenames) in os.walk(self.path):
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(filename)
+                except FileNotFoundError:  # evicted by another process
+                    continue
+                yield (st.st_mtime, filename, st.st_size)
+
+    def evict(self):
+        """Removes the least recently used entries, down to 3/4 of maxsize."""
+        entries = sorted(self._entries())
+        self.size = sum(size for (_, _, size) in entries)
+        for (_, filename, size) in entries:
+            if self.size <= self.maxsize * 3 // 4:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
 
 class Page:
+    __slots__ = ('pageno', 'mediabox')
+
     def __init__(self, pageno, mediabox):
         self.pageno = pageno
         self.mediabox = mediabox
-        self.annots = []
 
     def __eq__(self, other):
         return self.pageno == other.pageno
@@ -163,6 +614,9 @@ class Page:
 
 
 class Annotation:
+    __slots__ = ('page', 'tagname', 'contents', 'rect', 'author', 'text',
+                 'boxes', 'startpos', 'key', '_textbuf')
+
     def __init__(
             self,
             page,
@@ -170,7 +624,8 @@ class Annotation:
             coords=None,
             rect=None,
             contents=None,
-            author=None):
+            author=None,
+            columns=COLUMNS_PER_PAGE):
         self.page = page
         self.tagname = tagname
         if contents == '':
@@ -180,35 +635,57 @@ class Annotation:
         self.rect = rect
         self.author = author
         self.text = ''
+        self._textbuf = None  # text captured on the page, until finalize()
 
+        # boxes are stored flat, as x0, y0, x1, y1 for each box in turn
         if coords is None:
             self.boxes = None
         else:
             assert len(coords) % 8 == 0
-            self.boxes = []
-            while coords != []:
-                (x0, y0, x1, y1, x2, y2, x3, y3) = coords[:8]
-                coords = coords[8:]
-                xvals = [x0, x1, x2, x3]
-                yvals = [y0, y1, y2, y3]
-                box = (min(xvals), min(yvals), max(xvals), max(yvals))
-                self.boxes.append(box)
+            boxes = []
+            for i in range(0, len(coords), 8):
+                xvals = coords[i:i + 8:2]
+                yvals = coords[i + 1:i + 8:2]
+                boxes += (min(xvals), min(yvals), max(xvals), max(yvals))
+            self.boxes = array('d', boxes)
+
+        self.startpos = self._startpos(columns)
+        # reading order; annotations without a position come first
+        self.key = self.startpos.key if self.startpos else (page.pageno,)
+
+    def getboxes(self):
+        """Yields each box as an (x0, y0, x1, y1) tuple."""
+        boxes = self.boxes or ()
+        for i in range(0, len(boxes), 4):
+            yield (boxes[i], boxes[i + 1], boxes[i + 2], boxes[i + 3])
 
     def capture(self, text):
+        buf = self._textbuf
+        if buf is None:
+            buf = self._textbuf = [self.text] if self.text else []
+
         if text == '\n':
             # Kludge for latex: elide hyphens
-            if self.text.endswith('-'):
-                self.text = self.text[:-1]
+            if buf and buf[-1].endswith('-'):
+                buf[-1] = buf[-1][:-1]
+                if not buf[-1]:
+                    buf.pop()
 
             # Join lines, treating newlines as space, while ignoring successive
             # newlines. This makes it easier for the for the renderer to
             # "broadcast" LTAnno newlines to active annotations regardless of
             # box hits. (Detecting paragraph breaks is tricky anyway, and left
             # for future future work!)
-            elif not self.text.endswith(' '):
-                self.text += ' '
-        else:
-            self.text += text
+            elif not (buf and buf[-1].endswith(' ')):
+                buf.append(' ')
+        elif text:
+            buf.append(text)
+
+    def finalize(self):
+        """Called when the page is complete, to join the captured text."""
+        if self._textbuf is not None:
+            self.text = ''.join(self._textbuf)
+            self._textbuf = None
 
     def gettext(self):
         if self.boxes:
@@ -222,42 +699,60 @@ class Annotation:
         else:
             return None
 
-    def getstartpos(self):
+    def _startpos(self, columns):
         if self.rect:
             (x0, y0, x1, y1) = self.rect
         elif self.boxes:
-            (x0, y0, x1, y1) = self.boxes[0]
+            (x0, y0, x1, y1) = self.boxes[:4]
         else:
             return None
         # XXX: assume left-to-right top-to-bottom text
-        return Pos(self.page, min(x0, x1), max(y0, y1))
+        return Pos(self.page, min(x0, x1), max(y0, y1), columns)
 
-    # custom < operator for sorting
-    def __lt__(self, other):
-        return self.getstartpos() < other.getstartpos()
+    def getstartpos(self):
+        return self.startpos
+
+    def getstate(self):
+        """Returns the annotation's properties as a list of JSON types."""
+        return [self.tagname,
+                [float(v) for v in self.rect] if self.rect else None,
+                list(self.boxes) if self.boxes else None,
+                self.contents, self.author, self.text]
+
+    @classmethod
+    def fromstate(cls, page, state, columns=COLUMNS_PER_PAGE):
+        """Recreates an annotation on page from getstate()."""
+        (tagname, rect, boxes, contents, author, text) = state
+        coords = None
+        if boxes is not None:
+            # the corners of each box, in QuadPoints order
+            coords = []
+            for i in range(0, len(boxes), 4):
+                (x0, y0, x1, y1) = boxes[i:i + 4]
+                coords += (x0, y1, x1, y1, x0, y0, x1, y0)
+        a = cls(page, tagname, coords, rect, contents, author, columns)
+        a.text = text
+        return a
 
 
 class Pos:
-    def __init__(self, page, x, y):
+    __slots__ = ('page', 'x', 'y', 'key')
+
+    def __init__(self, page, x, y, columns=COLUMNS_PER_PAGE):
+        """
+        columns  Number of columns on the page, which determines reading order
+        """
         self.page = page
         self.x = x
         self.y = y
 
-    def __lt__(self, other):
-        if self.page < other.page:
-            return True
-        elif self.page == other.page:
-            assert self.page is other.page
-            # XXX: assume left-to-right top-to-bottom documents
-            (sx, sy) = self.normalise_to_mediabox()
-            (ox, oy) = other.normalise_to_mediabox()
-            (x0, y0, x1, y1) = self.page.mediabox
-            colwidth = (x1 - x0) / COLUMNS_PER_PAGE
-            self_col = (sx - x0) // colwidth
-            other_col = (ox - x0) // colwidth
-            return self_col < other_col or (self_col == other_col and sy > oy)
-        else:
-            return False
+        # Positions are compared by this (page, column, -y, x) key, so that
+        # sorting them yields reading order.
+        # XXX: assume left-to-right top-to-bottom documents
+        (nx, ny) = self.normalise_to_mediabox()
+        (x0, y0, x1, y1) = page.mediabox
+        colwidth = (x1 - x0) / columns
+        self.key = (page.pageno, (nx - x0) // colwidth, -ny, nx)
 
     def normalise_to_mediabox(self):
         x, y = self.x, self.y
@@ -273,12 +768,110 @@ class Pos:
         return (x, y)
 
 
-def getannots(pdfannots, page):
+def parse_pages(spec):
+    """
+    Parses a list of page ranges such as "1-3,7,10-", counting from 1, into
+    a sorted list of (first, last) pairs of page numbers counting from 0,
+    where last is None for the end of the document.
+    """
+    ranges = []
+    for part in spec.split(','):
+        (first, dash, last) = part.strip().partition('-')
+        try:
+            first = int(first) if first else 1
+            last = None if dash and not last else int(last or first)
+        except ValueError:
+            raise ValueError("invalid page range: '%s'" % part) from None
+        if first < 1 or (last is not None and last < first):
+            raise ValueError("invalid page range: '%s'" % part)
+        ranges.append((first - 1, None if last is None else last - 1))
+    return sorted(ranges, key=lambda r: r[0])
+
+
+class AnnotationFilter:
+    """
+    Which annotations are wanted, so that pages, annotations and content
+    streams that cannot contribute to the output are skipped before any work
+    is spent on them.
+    """
+
+    def __init__(self, pages=None, subtypes=None, authors=None,
+                 sections=None):
+        """
+        pages     If not None, parse_pages() ranges of the pages wanted
+        subtypes  If not None, the subtypes wanted
+        authors   If not None, the authors wanted, matched ignoring case
+        sections  If not None, the sections of grouped org output that are
+                  printed; annotations that belong in none are not wanted
+        """
+        self.pages = pages
+        self.subtypes = None if subtypes is None else frozenset(subtypes)
+        self.authors = None if authors is None else frozenset(
+            a.casefold() for a in authors)
+        self.sections = sections
+
+    @classmethod
+    def from_args(cls, args):
+        """Returns the filter that the options in args imply."""
+        grouped = args.format == 'org' and args.group
+        return cls(parse_pages(args.pages) if args.pages else None,
+                   args.subtypes, args.authors,
+                   args.sections if grouped else None)
+
+    def wants_page(self, pageno):
+        return self.pages is None or any(
+            first <= pageno and (last is None or pageno <= last)
+            for (first, last) in self.pages)
+
+    def past_pages(self, pageno):
+        """Are no pages after pageno wanted?"""
+        return self.pages is not None and all(
+            last is not None and last <= pageno
+            for (_, last) in self.pages)
+
+    def wants_subtype(self, subtype):
+        """
+        Could an annotation of the subtype be wanted, whatever its author and
+        contents? If not, neither need be decoded.
+        """
+        if self.subtypes is not None and subtype not in self.subtypes:
+            return False
+        if self.sections is not None and subtype in NIT_SUBTYPES:
+            return 'nits' in self.sections
+        return True
+
+    def wants(self, subtype, author, contents):
+        """Is an annotation wanted, given that its subtype may be?"""
+        if self.authors is not None and (
+                author is None or author.casefold() not in self.authors):
+            return False
+        if self.sections is not None:
+            # as OrgPrinter.printall_grouped assigns sections
+            if subtype in NIT_SUBTYPES:
+                return 'nits' in self.sections
+            elif contents:
+                return 'comments' in self.sections
+            return subtype == 'Highlight' and 'highlights' in self.sections
+        return True
+
+
+def getannots(pdfannots, page, columns=COLUMNS_PER_PAGE, wanted=None):
+    """
+    Returns the annotations on page, given its PDF annotation dictionaries.
+
+    wanted  If not None, an AnnotationFilter of the annotations to return
+    """
     annots = []
     for pa in pdfannots:
         subtype = pa.get('Subtype')
         if subtype is not None and subtype.name not in ANNOT_SUBTYPES:
             continue
+        if wanted is not None and not wanted.wants_subtype(subtype.name):
+            continue
+
+        author = pdfminer.pdftypes.resolve1(pa.get('T'))
+        if author is not None:
+            author = pdfminer.utils.decode_text(author)
 
         contents = pa.get('Contents')
         if contents is not None:
@@ -288,23 +881,68 @@ def getannots(pdfannots, page):
             contents = contents.replace('\r\n', '\n').replace('\r', '\n')
             contents = ''.join([SUBSTITUTIONS.get(c, c) for c in contents])
 
-        coords = pdftypes.resolve1(pa.get('QuadPoints'))
-        rect = pdftypes.resolve1(pa.get('Rect'))
-        author = pdftypes.resolve1(pa.get('T'))
-        if author is not None:
-            author = pdfminer.utils.decode_text(author)
+        if wanted is not None and not wanted.wants(subtype.name, author,
+                                                   contents):
+            continue
+
+        coords = pdfminer.pdftypes.resolve1(pa.get('QuadPoints'))
+        rect = pdfminer.pdftypes.resolve1(pa.get('Rect'))
         a = Annotation(
             page,
             subtype.name,
             coords,
             rect,
             contents,
-            author=author)
+            author=author,
+            columns=columns)
         annots.append(a)
 
     return annots
 
 
+class SpilledSection:
+    """
+    The formatted annotations of a section of grouped org output, by label,
+    written to a temporary file as they are received; only the position of
+    each in the file is kept in memory.
+    """
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.size = 0
+        self.spans = {}  # label -> [(offset, length)] of its text, in order
+
+    def __bool__(self):
+        return bool(self.spans)
+
+    def add(self, label, text, merge):
+        """
+        Adds the text of an annotation with the given label: after the text
+        of earlier annotations with the same label if merge, in their place
+        otherwise. Labels keep the position where they first appeared.
+        """
+        data = text.encode('utf-8')
+        self.file.write(data)
+        spans = self.spans.setdefault(label, [])
+        if not merge:
+            del spans[:]
+        spans.append((self.size, len(data)))
+        self.size += len(data)
+
+    def copy_to(self, outfile):
+        """Copies the section out to outfile, each label before its text."""
+        self.file.flush()
+        for (label, spans) in self.spans.items():
+            outfile.write(label)
+            for (offset, length) in spans:
+                self.file.seek(offset)
+                outfile.write(self.file.read(length).decode('utf-8'))
+            outfile.write('\n')
+
+    def close(self):
+        self.file.close()
+
+
 class OrgPrinter:
     """
     OrgPrinter is used to extract annotations in org-mode format
@@ -312,7 +950,7 @@ class OrgPrinter:
 
     def __init__(self, outlines, wrapcol, outfile):
         """
-        outlines List of outlines
+        outlines OutlineIndex of the document's outlines
         wrapcol  If not None, specifies the column at which output is word-wrapped
         """
         self.outlines = outlines
@@ -320,7 +958,7 @@ class OrgPrinter:
 
         self.outfile = outfile
 
-        self.annot_nits = frozenset({'Squiggly', 'StrikeOut', 'Underline'})
+        self.annot_nits = NIT_SUBTYPES
 
         self.INDENT = " "
 
@@ -338,13 +976,7 @@ class OrgPrinter:
             )
 
     def nearest_outline(self, pos):
-        prev = None
-        for o in self.outlines:
-            if o.pos < pos:
-                prev = o
-            else:
-                break
-        return prev
+        return self.outlines.nearest(pos)
 
     def format_pos(self, annot):
         apos = annot.getstartpos()
@@ -431,13 +1063,23 @@ class OrgPrinter:
         return self.format_bullet(msgparas, quotepos, quotelen)
 
     def printall(self, annots):
+        """
+        Prints each annotation as soon as it is received.
+        Returns the number of annotations.
+        """
+        nannots = 0
         for a in annots:
-            print(self.format_annot(a, a.tagname), file=self.outfile)
+            (label, body) = self.format_annot(a, a.tagname)
+            print(label + body, file=self.outfile)
+            nannots += 1
+        return nannots
 
     def printall_grouped(self, sections, annots):
         """
         sections controls the order of sections output
                 e.g.: ["highlights", "comments", "nits"]
+
+        Returns the number of annotations.
         """
         self._printheader_called = False
 
@@ -449,165 +1091,1078 @@ class OrgPrinter:
                 self._printheader_called = True
             print(f"* {name}\n", file=self.outfile)
 
-        highlights = [a for a in annots if a.tagname ==
-                      'Highlight' and a.contents is None]
-        comments = [
-            a for a in annots if a.tagname not in self.annot_nits and a.contents]
-        nits = [a for a in annots if a.tagname in self.annot_nits]
-
-        page_highlights, page_comments, page_nits = defaultdict(
-            str), defaultdict(str), defaultdict(str)
-
-        for section_name in sections:
-            if highlights and section_name == 'highlights':
-                printheader("Highlights")
-                for a in highlights:
-                    ph = self.format_annot(a)
-                    page_highlights[ph[0]] += ph[1] + '\n'
-                for k, v in page_highlights.items():
-                    print(k + v, file=self.outfile)
-
-            if comments and section_name == 'comments':
-                printheader("Detailed comments")
-                for a in comments:
-                    ps = self.format_annot(a)
-                    page_comments[ps[0]] = ps[1]
-                for k, v in page_comments.items():
-                    print(k + v, file=self.outfile)
-
-            if nits and section_name == 'nits':
-                printheader("Nits")
-                for a in nits:
-                    if a.tagname == 'StrikeOut':
-                        extra = "delete"
-                    else:
-                        extra = None
-                    pn = self.format_annot(a, extra)
-                    page_nits[pn[0]] = pn[1]
-                for k, v in page_nits.items():
-                    print(k + v, file=self.outfile)
-
-
-def resolve_dest(doc, dest):
+        # Each annotation is formatted as soon as it is received, and its
+        # formatted text spilled to its section's temporary file until the
+        # end. Highlights with the same label are merged, whereas for
+        # comments and nits, the last one wins.
+        with contextlib.ExitStack() as stack:
+            page_highlights, page_comments, page_nits = (
+                SpilledSection() for _ in range(3))
+            for section in (page_highlights, page_comments, page_nits):
+                stack.callback(section.close)
+
+            nannots = 0
+            for a in annots:
+                nannots += 1
+                if a.tagname in self.annot_nits:
+                    if 'nits' in sections:
+                        extra = "delete" if a.tagname == 'StrikeOut' else None
+                        pn = self.format_annot(a, extra)
+                        page_nits.add(pn[0], pn[1], merge=False)
+                elif a.contents:
+                    if 'comments' in sections:
+                        ps = self.format_annot(a)
+                        page_comments.add(ps[0], ps[1], merge=False)
+                elif a.tagname == 'Highlight' and a.contents is None:
+                    if 'highlights' in sections:
+                        ph = self.format_annot(a)
+                        page_highlights.add(ph[0], ph[1] + '\n', merge=True)
+
+            for section_name in sections:
+                if page_highlights and section_name == 'highlights':
+                    printheader("Highlights")
+                    page_highlights.copy_to(self.outfile)
+
+                if page_comments and section_name == 'comments':
+                    printheader("Detailed comments")
+                    page_comments.copy_to(self.outfile)
+
+                if page_nits and section_name == 'nits':
+                    printheader("Nits")
+                    page_nits.copy_to(self.outfile)
+
+        return nannots
+
+
+def annotation_record(annot, outlines):
+    """
+    Returns the properties of an annotation as a dict of JSON types, with the
+    title of the nearest outline in the OutlineIndex outlines.
+    """
+    pos = annot.getstartpos()
+    outline = outlines.nearest(pos) if pos else None
+    return {
+        'page': annot.page.pageno + 1,
+        'subtype': annot.tagname,
+        'rect': [float(v) for v in annot.rect] if annot.rect else None,
+        'boxes': [list(box) for box in annot.getboxes()],
+        'author': annot.author,
+        'contents': annot.contents,
+        'text': annot.gettext(),
+        'outline': outline.title if outline else None,
+    }
+
+
+class JsonLinesPrinter:
+    """
+    JsonLinesPrinter writes each annotation as a line of JSON, as it is
+    received
+    """
+
+    def __init__(self, outlines, outfile):
+        """
+        outlines  OutlineIndex of the document's outlines
+        """
+        self.outlines = outlines
+        self.outfile = outfile
+        self.encode = json.JSONEncoder(ensure_ascii=False).encode
+
+    def printall(self, annots):
+        """Returns the number of annotations."""
+        nannots = 0
+        for a in annots:
+            self.outfile.write(
+                self.encode(annotation_record(a, self.outlines)) + '\n')
+            nannots += 1
+        return nannots
+
+
+class ParquetPrinter:
+    """
+    ParquetPrinter writes the annotations as a Parquet table, one row group
+    for each batch of annotations received
+    """
+
+    BATCH_SIZE = 10000  # rows buffered before a row group is written
+
+    def __init__(self, outlines, outfile):
+        """
+        outlines  OutlineIndex of the document's outlines
+        outfile   Binary file to write to
+        """
+        self.outlines = outlines
+        self.outfile = outfile
+
+    @staticmethod
+    def schema():
+        import pyarrow as pa
+
+        return pa.schema([
+            ('page', pa.int32()),
+            ('subtype', pa.string()),
+            ('rect', pa.list_(pa.float64())),
+            ('boxes', pa.list_(pa.list_(pa.float64()))),
+            ('author', pa.string()),
+            ('contents', pa.string()),
+            ('text', pa.string()),
+            ('outline', pa.string()),
+        ])
+
+    def printall(self, annots):
+        """Returns the number of annotations."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = self.schema()
+        nannots = 0
+        with pq.ParquetWriter(self.outfile, schema) as writer:
+            batch = []
+            for a in annots:
+                batch.append(annotation_record(a, self.outlines))
+                if len(batch) == self.BATCH_SIZE:
+                    writer.write_table(pa.Table.from_pylist(batch, schema))
+                    nannots += len(batch)
+                    batch = []
+            # an empty table still records the schema
+            writer.write_table(pa.Table.from_pylist(batch, schema))
+            nannots += len(batch)
+        return nannots
+
+
+def named_dests(doc):
+    """
+    Returns a map from name to destination of the document's named
+    destinations: those in the name tree of the /Dests entry of its /Names
+    dictionary, by byte string, and those in the /Dests dictionary of its
+    catalog (PDF 1.1), by name.
+    """
+    dests = dict(pdfminer.pdftypes.dict_value(doc.catalog.get('Dests', {})))
+
+    names = pdfminer.pdftypes.resolve1(doc.catalog.get('Names'))
+    if isinstance(names, dict) and 'Dests' in names:
+        nodes = [names['Dests']]
+        seen = set()  # object IDs of the nodes visited, against cycles
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, pdfminer.pdftypes.PDFObjRef):
+                if node.objid in seen:
+                    continue
+                seen.add(node.objid)
+            node = pdfminer.pdftypes.resolve1(node)
+            if not isinstance(node, dict):
+                continue
+            pairs = pdfminer.pdftypes.resolve1(node.get('Names', []))
+            for i in range(0, len(pairs) - 1, 2):
+                dests[pdfminer.pdftypes.resolve1(pairs[i])] = pairs[i + 1]
+            nodes += pdfminer.pdftypes.resolve1(node.get('Kids', []))
+    return dests
+
+
+def resolve_dest(dest, dests):
+    """
+    Resolves a destination that may be named, with the named_dests dests,
+    to an explicit destination; returns None if its name is not defined.
+    """
     if isinstance(dest, bytes):
-        dest = pdftypes.resolve1(doc.get_dest(dest))
-    elif isinstance(dest, PSLiteral):
-        dest = pdftypes.resolve1(doc.get_dest(dest.name))
+        dest = pdfminer.pdftypes.resolve1(dests.get(dest))
+    elif isinstance(dest, pdfminer.psparser.PSLiteral):
+        dest = pdfminer.pdftypes.resolve1(dests.get(dest.name))
     if isinstance(dest, dict):
-        dest = dest['D']
+        dest = pdfminer.pdftypes.resolve1(dest.get('D'))
     return dest
 
 
+def dest_position(dest, mediabox):
+    """
+    Returns the (x, y) coordinates of the top left corner of the view of an
+    explicit destination [page /Type args...], on a page with the given
+    media box. Coordinates the destination leaves unspecified, or null, are
+    those of the page's corner.
+    """
+    kind = (dest[1].name if isinstance(dest[1], pdfminer.psparser.PSLiteral)
+            else None)
+    args = [pdfminer.pdftypes.resolve1(v) for v in dest[2:6]] + [None] * 4
+    (left, top) = (None, None)
+    if kind == 'XYZ':  # left top zoom
+        (left, top) = args[:2]
+    elif kind in ('FitH', 'FitBH'):  # top
+        top = args[0]
+    elif kind in ('FitV', 'FitBV'):  # left
+        left = args[0]
+    elif kind == 'FitR':  # left bottom right top
+        (left, top) = (args[0], args[3])
+    # else /Fit or /FitB: the whole page
+    (x0, _, _, y1) = mediabox
+    return (x0 if left is None else left, y1 if top is None else top)
+
+
 class Outline:
+    __slots__ = ('title', 'dest', 'pos')
+
     def __init__(self, title, dest, pos):
         self.title = title
         self.dest = dest
         self.pos = pos
 
 
-def get_outlines(doc, pageslist, pagesdict):
+class OutlineIndex:
+    """
+    Outlines sorted in reading order, to find the section containing a given
+    position by binary search.
+    """
+
+    def __init__(self, outlines):
+        self.outlines = sorted(outlines, key=lambda o: o.pos.key)
+        self.keys = [o.pos.key for o in self.outlines]
+
+    def nearest(self, pos):
+        """Returns the last outline before pos, or None."""
+        i = bisect.bisect_left(self.keys, pos.key)
+        return self.outlines[i - 1] if i else None
+
+
+class LazyOutlineIndex(OutlineIndex):
+    """
+    OutlineIndex of the outlines returned by resolve(), which is only called
+    once they are first needed, if ever.
+    """
+
+    def __init__(self, resolve):
+        self._resolve = resolve
+
+    def __getattr__(self, name):
+        # only called while outlines and keys are not yet set
+        if name not in ('outlines', 'keys'):
+            raise AttributeError(name)
+        OutlineIndex.__init__(self, self._resolve())
+        return getattr(self, name)
+
+
+def get_outlines(doc, pageslist, pagesdict, columns=COLUMNS_PER_PAGE):
+    """Returns the document's outlines, sorted in reading order."""
     result = []
+    dests = None  # named_dests, once one is needed
     for (_, title, destname, actionref, _) in doc.get_outlines():
         if destname is None and actionref:
-            action = pdftypes.resolve1(actionref)
+            action = pdfminer.pdftypes.resolve1(actionref)
             if isinstance(action, dict):
                 subtype = action.get('S')
-                if subtype is PSLiteralTable.intern('GoTo'):
+                if subtype is pdfminer.psparser.PSLiteralTable.intern('GoTo'):
                     destname = action.get('D')
         if destname is None:
             continue
-        dest = resolve_dest(doc, destname)
+        if dests is None and isinstance(
+                destname, (bytes, pdfminer.psparser.PSLiteral)):
+            dests = named_dests(doc)
+        dest = resolve_dest(destname, dests)
+
+        # explicit destinations are [page /Type args...]
+        if not isinstance(dest, list) or len(dest) < 2:
+            sys.stderr.write(
+                'Warning: unsupported destination in outline: %s\n' %
+                destname)
+            continue
+        pageref = dest[0]
+        if isinstance(pageref, int):
+            page = pageslist[pageref]
+        elif isinstance(pageref, pdfminer.pdftypes.PDFObjRef):
+            page = pagesdict[pageref.objid]
+        else:
+            sys.stderr.write(
+                'Warning: unsupported pageref in outline: %s\n' %
+                pageref)
+            page = None
+
+        if page:
+            (targetx, targety) = dest_position(dest, page.mediabox)
+            pos = Pos(page, targetx, targety, columns)
+            result.append(Outline(title, destname, pos))
+    result.sort(key=lambda o: o.pos.key)
+    return result
 
-        # consider targets of the form [page /XYZ left top zoom]
-        if dest[1] is PSLiteralTable.intern('XYZ'):
-            (pageref, _, targetx, targety) = dest[:4]
 
-            if isinstance(pageref, int):
-                page = pageslist[pageref]
-            elif isinstance(pageref, pdftypes.PDFObjRef):
-                page = pagesdict[pageref.objid]
-            else:
-                sys.stderr.write(
-                    'Warning: unsupported pageref in outline: %s\n' %
-                    pageref)
-                page = None
+class DocumentInfo:
+    def __init__(self, title, author, npages):
+        self.title = title
+        self.author = author
+        self.npages = npages
+
+
+def getdocinfo(doc, npages):
+    """
+    Reads the document information dictionary. pdfminer keeps one for each
+    trailer, most recent first, so the first definition of each entry wins.
+    """
+
+    def getinfo(key):
+        for info in doc.info:
+            value = pdfminer.pdftypes.resolve1(info.get(key))
+            if isinstance(value, bytes):
+                return pdfminer.utils.decode_text(value)
+            elif isinstance(value, str):
+                return value
+        return None
+
+    return DocumentInfo(getinfo('Title'), getinfo('Author'), npages)
+
 
-            if page:
-                pos = Pos(page, targetx, targety)
-                result.append(Outline(title, destname, pos))
+def peak_rss():
+    """Peak resident set size of this process in KiB, or None if unknown."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def current_rss():
+    """Resident set size of this process in KiB, or None if unknown."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * (os.sysconf('SC_PAGE_SIZE') // 1024)
+
+
+def drop_caches(doc, rsrcmgr=None):
+    """
+    Drops the objects pdfminer has parsed from doc and the fonts loaded by
+    rsrcmgr (if not None), which are parsed again if needed.
+    """
+    doc._cached_objs.clear()
+    doc._parsed_objs.clear()
+    if rsrcmgr is not None:
+        rsrcmgr.clear()
+
+
+def trim_caches(doc, rsrcmgr, limit):
+    """
+    If this process uses more than limit KiB of memory, or its use is
+    unknown, calls drop_caches. Returns whether it did.
+    """
+    rss = current_rss()
+    if rss is not None and rss <= limit:
+        return False
+    drop_caches(doc, rsrcmgr)
+    return True
+
+
+class Stats:
+    """
+    Timings and counters of the processing of one file, for --stats. A line
+    of JSON is written for each annotated page as it completes, and one for
+    the whole file by finish(). Times are in seconds; process_page includes
+    layout analysis and hit-testing, and hittest includes text capture.
+    """
+
+    def __init__(self, filename, path):
+        """
+        path  File to which lines are appended, or "-" for standard error
+        """
+        self.filename = filename
+        self.path = path
+        self.start = time.perf_counter()
+        self.totals = dict(open=0.0, outlines=0.0, pages=0,
+                           **self.newpage(), annots=0, trims=0, reused=0)
+
+    @staticmethod
+    def newpage():
+        """Returns an empty page record."""
+        return dict(process_page=0.0, hittest=0.0, glyphs=0, boxhits=0)
+
+    def add(self, name, value):
+        self.totals[name] += value
+
+    def page(self, pageno, annots, record):
+        """Reports a completed page, and adds its record to the totals."""
+        for (k, v) in record.items():
+            if k in self.totals:
+                self.totals[k] += v
+        self.totals['pages'] += 1
+        self.totals['annots'] += len(annots)
+        record = dict(record, annots=len(annots))
+        record.setdefault('peak_rss_kb', peak_rss())
+        self.emit(page=pageno + 1, **record)
+
+    def finish(self):
+        """Reports the totals for the file."""
+        self.emit(wall=time.perf_counter() - self.start,
+                  peak_rss_kb=peak_rss(), **self.totals)
+
+    def emit(self, **record):
+        record = {k: round(v, 6) if isinstance(v, float) else v
+                  for (k, v) in record.items()}
+        line = json.dumps(dict(file=self.filename, **record)) + '\n'
+        if self.path == '-':
+            sys.stderr.write(line)
+        else:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+
+EXTRACTORS = {
+    'python': RectExtractor,
+    'numpy': BatchRectExtractor,
+}
+
+_devices = {}  # engine -> device class, once defined
+
+
+def device_class(engine):
+    """
+    Returns the pdfminer device class of the given engine, a TextConverter
+    with the logic of the engine's RectExtractor class, defining it on first
+    use.
+    """
+    if engine not in _devices:
+        extractor = EXTRACTORS[engine]
+
+        class Device(extractor, pdfminer.converter.TextConverter):
+            __doc__ = extractor.__doc__
+
+        _devices[engine] = Device
+    return _devices[engine]
+
+
+FONT_CACHE_SIZE = 64  # fonts kept across documents by FontCache
+
+
+class FontCache:
+    """
+    The fonts kept by SharedResources from one document to the next, so that
+    a batch of documents using the same embedded fonts decodes each of them
+    once per process. Fonts are keyed by a digest of their dictionary and
+    everything it references, font program and ToUnicode CMap included;
+    beyond maxfonts, the least recently used is evicted. (pdfminer itself
+    keeps predefined CMaps and the metrics of the standard 14 fonts for the
+    life of the process.)
+    """
+
+    def __init__(self, maxfonts=FONT_CACHE_SIZE):
+        self.maxfonts = maxfonts
+        self.fonts = OrderedDict()  # digest -> font, least recent first
+
+    def get(self, key):
+        font = self.fonts.get(key)
+        if font is not None:
+            self.fonts.move_to_end(key)
+        return font
+
+    def put(self, key, font):
+        self.fonts[key] = font
+        if len(self.fonts) > self.maxfonts:
+            self.fonts.popitem(last=False)
+
+    def clear(self):
+        self.fonts.clear()
+
+
+class SharedResources:
+    """
+    Mixin for pdfminer's PDFResourceManager of a single document, which takes
+    the fonts it loads from a FontCache shared with other documents. The
+    fonts of the document, which pdfminer keys by object ID, are kept apart,
+    so that documents may be processed at the same time.
+    """
+
+    def __init__(self, fonts, memo):
+        """
+        fonts  The FontCache
+        memo   Map from object ID to digest for the document, as for
+               digest_object
+        """
+        super().__init__()
+        self.fonts = fonts
+        self.memo = memo
+
+    def clear(self):
+        self._cached_fonts.clear()
+        self.fonts.clear()
+
+    def get_font(self, objid, spec):
+        # fonts without an object ID are parts of a composite font, which is
+        # kept as a whole
+        if (not objid or objid in self._cached_fonts
+                or not self.fonts.maxfonts):
+            return super().get_font(objid, spec)
+
+        h = hashlib.sha256()
+        digest_object(spec, self.memo, h)
+        key = h.digest()
+        font = self.fonts.get(key)
+        if font is None:
+            font = super().get_font(objid, spec)
+            self.fonts.put(key, font)
+        else:
+            self._cached_fonts[objid] = font
+        return font
+
+
+_fonts = FontCache()  # shared by all documents processed in this process
+_resource_manager = None  # resource manager class, once defined
+
+
+def shared_fonts():
+    """Returns the FontCache shared by all documents in this process."""
+    return _fonts
+
+
+def resource_manager(memo):
+    """
+    Returns a resource manager for a document, sharing the process's fonts.
+
+    memo  As for SharedResources
+    """
+    global _resource_manager
+    if _resource_manager is None:
+        class SharedResourceManager(SharedResources,
+                                    pdfminer.pdfinterp.PDFResourceManager):
+            __doc__ = SharedResources.__doc__
+
+        _resource_manager = SharedResourceManager
+    return _resource_manager(shared_fonts(), memo)
+
+
+def make_extractor(engine, restrict, memo):
+    """
+    Returns a device and interpreter for a document.
+
+    memo  Map from object ID to digest for the document, as for
+          digest_object
+    """
+    rsrcmgr = resource_manager(memo)
+    laparams = pdfminer.layout.LAParams()
+    device = device_class(engine)(rsrcmgr, laparams=laparams,
+                                  restrict=restrict)
+    interpreter = pdfminer.pdfinterp.PDFPageInterpreter(rsrcmgr, device)
+    return device, interpreter
+
+
+def getpdfannots(pdfpage):
+    pdfannots = []
+    for a in pdfminer.pdftypes.resolve1(pdfpage.annots):
+        if isinstance(a, pdfminer.pdftypes.PDFObjRef):
+            pdfannots.append(a.resolve())
+        else:
+            sys.stderr.write('Warning: unknown annotation: %s\n' % a)
+    return pdfannots
+
+
+def extract_page(device, interpreter, pdfpage, annots, cache, memo,
+                 stats=None):
+    """
+    Captures the text of the annotations on the given page, reusing the
+    page's cached layout if there is one.
+
+    stats  If not None, a page record of Stats, to which this adds
+    """
+    device.setannots(annots)
+    device.stats = stats
+    start = time.perf_counter()
+    if cache is None:
+        interpreter.process_page(pdfpage)
+    else:
+        key = cache.key(pdfpage, memo)
+        glyphs = cache.get(key)
+        if glyphs is None:
+            device.keepglyphs = True
+            interpreter.process_page(pdfpage)
+            cache.put(key, device.glyphs)
+        else:
+            device.receive_glyphs(glyphs)
+    if stats is not None:
+        stats['process_page'] += time.perf_counter() - start
+
+
+def extract_pages(path, pagenos, engine, restrict, cache, stats=False,
+                  max_memory=None, wanted=None):
+    """
+    Entry point of worker processes for page-sharded extraction: extracts the
+    given pages of the named file, and returns a map from page number to
+    (the text captured by each of its annotations in getannots order, and
+    the page's Stats record if stats is set, else None).
+    """
+    pagenos = frozenset(pagenos)
+    memo = {}
+    (device, interpreter) = make_extractor(engine, restrict, memo)
+    result = {}
+    with open_input(path) as fh:
+        doc = pdfminer.pdfdocument.PDFDocument(
+            pdfminer.pdfparser.PDFParser(fh))
+        pdfpages = pdfminer.pdfpage.PDFPage.create_pages(doc)
+        for (pageno, pdfpage) in enumerate(pdfpages):
+            if max_memory:
+                trim_caches(doc, device.rsrcmgr, max_memory)
+            if pageno in pagenos:
+                page = Page(pageno, pdfpage.mediabox)
+                annots = getannots(getpdfannots(pdfpage), page,
+                                   wanted=wanted)
+                record = Stats.newpage() if stats else None
+                extract_page(device, interpreter, pdfpage, annots, cache, memo,
+                             record)
+                if record is not None:
+                    record['peak_rss_kb'] = peak_rss()
+                result[pageno] = ([a.text for a in annots], record)
+                if len(result) == len(pagenos):
+                    break
+        drop_caches(doc)
+    device.close()
     return result
 
 
-def pdftitle(fh):
-    pdf_reader = PdfFileReader(fh)
-    docinfo = pdf_reader.getDocumentInfo()
-    return docinfo.title if (docinfo and docinfo.title) else ''
+def extract_pages_parallel(path, pagenos, jobs, engine, restrict, cache,
+                           stats, max_memory, wanted):
+    """
+    Runs extract_pages on shards of the given pages in a pool of worker
+    processes. Yields (page number, (texts, stats record)) for each page, in
+    page order, as soon as the shard containing it is complete.
+    """
+    import concurrent.futures
 
+    # several contiguous shards per worker, to balance uneven pages
+    nshards = min(len(pagenos), jobs * 2)
+    shards = [pagenos[i * len(pagenos) // nshards:
+                      (i + 1) * len(pagenos) // nshards]
+              for i in range(nshards)]
 
-def process_file(fh, emit_progress):
-    rsrcmgr = PDFResourceManager()
-    laparams = LAParams()
-    device = RectExtractor(rsrcmgr, laparams=laparams)
-    interpreter = PDFPageInterpreter(rsrcmgr, device)
-    parser = PDFParser(fh)
-    doc = PDFDocument(parser)
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        futures = [pool.submit(extract_pages, path, shard, engine, restrict,
+                               cache, stats, max_memory, wanted)
+                   for shard in shards]
+        for future in futures:
+            yield from sorted(future.result().items())
 
-    pageslist = []  # pages in page order
-    pagesdict = {}  # map from PDF page object ID to Page object
-    allannots = []
 
-    for (pageno, pdfpage) in enumerate(PDFPage.create_pages(doc)):
-        page = Page(pageno, pdfpage.mediabox)
-        pageslist.append(page)
-        pagesdict[pdfpage.pageid] = page
-        if pdfpage.annots:
-            # emit progress indicator
-            if emit_progress:
+def iter_annotations(doc, pageslist, emit_progress, engine, restrict,
+                     pagejobs, cache, columns, path, stats, max_memory,
+                     reuse=None, delta=None, wanted=None):
+    """
+    Generator behind extract_annotations: yields the annotations of each page
+    in turn, once its text has been captured.
+
+    reuse  If not None, map from page number to the annotations of
+           annotated pages known to be unchanged, which are yielded instead
+           of extracted
+    delta  If not None, a Delta to which the annotations of each page are
+           added as they are yielded
+    wanted If not None, an AnnotationFilter of the annotations to yield
+    """
+    memo = {}  # object digests, for cache keys and fonts
+    (device, interpreter) = make_extractor(engine, restrict, memo)
+    skipped = 0  # annotated pages with nothing to extract from the layout
+    deferred = []  # (page, annots, stats) awaiting workers, if pagejobs > 1
+    pending = []  # numbers of the deferred pages that workers must extract
+
+    try:
+        pdfpages = pdfminer.pdfpage.PDFPage.create_pages(doc)
+        for (page, pdfpage) in zip(pageslist, pdfpages):
+            # nothing parsed from the document needs to be kept beyond the
+            # page at hand; whatever the outlines need is parsed again
+            if max_memory and trim_caches(doc, device.rsrcmgr, max_memory):
+                if stats:
+                    stats.add('trims', 1)
+            if wanted is not None and not wanted.wants_page(page.pageno):
+                if wanted.past_pages(page.pageno):
+                    break
+                continue
+
+            reused = reuse.get(page.pageno) if reuse is not None else None
+            if reused is None and not pdfpage.annots:
+                continue
+
+            # emit progress indicator (for pages extracted by workers, this
+            # happens as they are received)
+            if emit_progress and pagejobs == 1:
                 sys.stderr.write(
-                    (" " if pageno > 0 else "") + "%d" %
-                    (pageno + 1))
+                    (" " if page.pageno > 0 else "") + "%d" %
+                    (page.pageno + 1))
                 sys.stderr.flush()
 
-            pdfannots = []
-            for a in pdftypes.resolve1(pdfpage.annots):
-                if isinstance(a, pdftypes.PDFObjRef):
-                    pdfannots.append(a.resolve())
+            record = Stats.newpage() if stats else None
+            if reused is not None:
+                annots = reused
+                if stats:
+                    stats.add('reused', 1)
+            else:
+                annots = getannots(getpdfannots(pdfpage), page, columns,
+                                   wanted)
+
+                # Only annotations with QuadPoints capture text, so if there
+                # are none (e.g. the page only carries sticky notes), the
+                # content stream need not be interpreted at all.
+                if not any(a.boxes for a in annots):
+                    skipped += 1
+                elif pagejobs > 1:
+                    pending.append(page.pageno)
                 else:
-                    sys.stderr.write('Warning: unknown annotation: %s\n' % a)
-
-            page.annots = getannots(pdfannots, page)
-            page.annots.sort()
-            device.setannots(page.annots)
-            interpreter.process_page(pdfpage)
-            allannots.extend(page.annots)
+                    extract_page(device, interpreter, pdfpage, annots, cache,
+                                 memo, record)
 
-    if emit_progress:
-        sys.stderr.write("\n")
+            if pagejobs > 1:
+                deferred.append((page, annots, record))
+            else:
+                if stats:
+                    stats.page(page.pageno, annots, record)
+                if delta is not None:
+                    delta.add(page.pageno, annots)
+                yield from sorted(annots, key=lambda a: a.key)
+
+        if deferred:
+            results = extract_pages_parallel(
+                path, pending, pagejobs, engine, restrict, cache,
+                stats is not None, max_memory, wanted)
+            for (page, annots, record) in deferred:
+                if pending and pending[0] == page.pageno:
+                    (_, (texts, workerrecord)) = next(results)
+                    for (a, text) in zip(annots, texts):
+                        a.text = text
+                    pending.pop(0)
+                    record = workerrecord or record
+                if emit_progress:
+                    sys.stderr.write(
+                        (" " if page.pageno > 0 else "") + "%d" %
+                        (page.pageno + 1))
+                    sys.stderr.flush()
+                if stats:
+                    stats.page(page.pageno, annots, record)
+                if delta is not None:
+                    delta.add(page.pageno, annots)
+                yield from sorted(annots, key=lambda a: a.key)
 
-    outlines = []
-    try:
-        outlines = get_outlines(doc, pageslist, pagesdict)
-    except PDFNoOutlines:
         if emit_progress:
-            sys.stderr.write(
-                "Document doesn't include outlines (\"bookmarks\")\n")
-    except Exception as ex:
-        sys.stderr.write("Warning: failed to retrieve outlines: %s\n" % ex)
+            sys.stderr.write("\n")
+            if skipped:
+                sys.stderr.write(
+                    "Skipped layout analysis of %d page(s) without text "
+                    "markup\n" % skipped)
+    finally:
+        # fonts kept for later documents may still refer to this one, so
+        # that its parsed objects would otherwise live on with them
+        drop_caches(doc)
+        device.close()
 
-    device.close()
 
-    return allannots, outlines
+@contextlib.contextmanager
+def open_input(path):
+    """
+    Opens an input file for PDFParser, given its path or "-" for standard
+    input, and closes it on exit. A read-only memory map of the file is used
+    if possible, which spares the parser's many small seeks and reads the
+    overhead of buffered I/O; failing that, the file itself if it is
+    seekable, else its contents read into memory.
+    """
+    if path == '-':
+        yield io.BytesIO(sys.stdin.buffer.read())
+        return
+
+    with open(path, 'rb') as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            # e.g. an empty file, a pipe, or a file system without mmap
+            yield f if f.seekable() else io.BytesIO(f.read())
+            return
+        with mapped:
+            yield mapped
+
+
+class Delta:
+    """
+    What an earlier run found in a document, saved as JSON, from which a
+    later run re-extracts only the pages changed by incremental updates
+    appended to the document since.
+    """
+
+    VERSION = 1
+
+    def __init__(self):
+        self.size = None  # size of the document, in bytes
+        self.digest = None  # SHA-256 digest of the document, in hex
+        self.pageids = None  # object IDs of its pages, in order
+        self.annots = {}  # page number -> Annotation.getstate() of each
+
+    @classmethod
+    def load(cls, filename):
+        """Reads a saved Delta, or returns an empty one if there is none."""
+        delta = cls()
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return delta
+        except ValueError as ex:
+            sys.stderr.write("Warning: ignoring invalid delta state %s: %s\n"
+                             % (filename, ex))
+            return delta
+        if data.get('version') == cls.VERSION:
+            delta.size = data['size']
+            delta.digest = data['digest']
+            delta.pageids = data['pageids']
+            delta.annots = {int(k): v for (k, v) in data['annots'].items()}
+        return delta
+
+    def save(self, filename):
+        os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+        with atomic_write(filename) as f:
+            json.dump(dict(version=self.VERSION, size=self.size,
+                           digest=self.digest, pageids=self.pageids,
+                           annots=self.annots), f)
+
+    def add(self, pageno, annots):
+        if annots:
+            self.annots[pageno] = [a.getstate() for a in annots]
+
+
+def appended_objects(doc, size):
+    """
+    Returns the IDs of the objects of doc that are stored beyond its first
+    size bytes: those that incremental updates appended since it had that
+    size have added or changed.
+    """
+    # the xrefs are newest first, and the newest entry for an object wins
+    positions = {}
+    for xref in reversed(doc.xrefs):
+        for objid in xref.get_objids():
+            try:
+                positions[objid] = xref.get_pos(objid)
+            except KeyError:  # a free entry
+                pass
+
+    def offset(objid):
+        (strmid, pos, _) = positions.get(objid, (None, -1, 0))
+        # objects in object streams are where their stream is
+        return pos if strmid is None else offset(strmid)
+
+    return {objid for objid in positions if offset(objid) >= size}
+
+
+# keys by which pages and annotations refer to the page tree or to other
+# pages, rather than to what they are made of
+ELSEWHERE_KEYS = frozenset(('Parent', 'P', 'Dest', 'A', 'B'))
+
+
+def refers_to(obj, changed, memo):
+    """
+    Does obj refer, directly or through other objects, to an object whose ID
+    is in changed? References under ELSEWHERE_KEYS are not followed.
+
+    memo  Map from object ID to the answer for that object, for the document
+    """
+    if isinstance(obj, pdfminer.pdftypes.PDFObjRef):
+        if obj.objid not in memo:
+            memo[obj.objid] = obj.objid in changed  # also guards cycles
+            if not memo[obj.objid]:
+                memo[obj.objid] = refers_to(obj.resolve(), changed, memo)
+        return memo[obj.objid]
+    elif isinstance(obj, dict):
+        return any(refers_to(v, changed, memo) for (k, v) in obj.items()
+                   if k not in ELSEWHERE_KEYS)
+    elif isinstance(obj, list):
+        return any(refers_to(v, changed, memo) for v in obj)
+    elif isinstance(obj, pdfminer.pdftypes.PDFStream):
+        return refers_to(obj.attrs, changed, memo)
+    return False
+
+
+def page_changed(pdfpage, changed, memo):
+    """
+    Do the IDs of changed include the page object of pdfpage, any object its
+    attributes refer to (its annotations, content streams, and the fonts and
+    form XObjects of its resources among them), or a node of the page tree
+    from which it may inherit an attribute?
+
+    memo  As for refers_to()
+    """
+    if pdfpage.pageid in changed:
+        return True
+    if refers_to(pdfpage.attrs, changed, memo):
+        return True
+
+    # an update to a Pages node can change the attributes it passes down
+    own = pdfminer.pdftypes.dict_value(pdfpage.doc.getobj(pdfpage.pageid))
+    if any(k in pdfpage.attrs and k not in own
+           for k in pdfminer.pdfpage.PDFPage.INHERITABLE_ATTRS):
+        parent = own.get('Parent')
+        seen = set()  # against cycles
+        while (isinstance(parent, pdfminer.pdftypes.PDFObjRef)
+               and parent.objid not in seen):
+            if parent.objid in changed:
+                return True
+            seen.add(parent.objid)
+            parent = pdfminer.pdftypes.dict_value(parent).get('Parent')
+    return False
+
+
+def extract_annotations(fh, emit_progress, engine='python', restrict=False,
+                        pagejobs=1, cache=None, columns=COLUMNS_PER_PAGE,
+                        stats=None, path=None, max_memory=None, delta=None,
+                        wanted=None):
+    """
+    Opens a document. Returns (annots, outlines, info), where annots is an
+    iterator that processes the document page by page, yielding the
+    annotations of each page in reading order as soon as it is complete, and
+    outlines is an OutlineIndex of the document's outlines, which are only
+    resolved once first needed, so fh must be open until then.
+
+    fh        The document, as returned by open_input()
+    columns   Number of columns per page, which determines reading order
+    path      Name of the document's file
+    pagejobs  If greater than 1, distribute the annotated pages across this
+              many worker processes, which need path. The annotations are
+              then only yielded once every page has been read, so they are
+              all held in memory rather than streamed.
+    cache     If not None, a GlyphCache of page layouts (not with restrict)
+    stats     If not None, a Stats to which timings and counters are added
+    max_memory  If set, drop pdfminer's caches for the document whenever
+              memory use exceeds this many KiB after a page
+    delta     If not None, a Delta of an earlier version of the document
+              whose first delta.size bytes this one begins with; pages the
+              updates appended since left unchanged are taken from it. It
+              is updated with the annotations found, but its size and
+              digest are left to the caller.
+    wanted    If not None, an AnnotationFilter; only the pages and
+              annotations it wants are extracted
+    """
+    start = time.perf_counter()
+    parser = pdfminer.pdfparser.PDFParser(fh)
+    doc = pdfminer.pdfdocument.PDFDocument(parser)
+
+    changed = None  # IDs of objects changed since delta, if known
+    if delta is not None and delta.pageids is not None:
+        changed = appended_objects(doc, delta.size)
+    reaches = {}  # memo of page_changed()
+
+    pageslist = []  # pages in page order
+    pagesdict = {}  # map from PDF page object ID to Page object
+    unchanged = []  # numbers of pages that changed leaves alone
+    pdfpages = pdfminer.pdfpage.PDFPage.create_pages(doc)
+    for (pageno, pdfpage) in enumerate(pdfpages):
+        page = Page(pageno, pdfpage.mediabox)
+        pageslist.append(page)
+        pagesdict[pdfpage.pageid] = page
+        if (changed is not None
+                and not page_changed(pdfpage, changed, reaches)):
+            unchanged.append(pageno)
+        if max_memory:
+            trim_caches(doc, None, max_memory)
+    if stats:
+        stats.add('open', time.perf_counter() - start)
+
+    reuse = None
+    if delta is not None:
+        # if pages were added, removed or reordered, start afresh
+        if changed is not None and delta.pageids == list(pagesdict):
+            reuse = {pageno: [Annotation.fromstate(pageslist[pageno], state,
+                                                   columns)
+                              for state in delta.annots[pageno]]
+                     for pageno in unchanged if pageno in delta.annots}
+        delta.pageids = list(pagesdict)
+        delta.annots = {}
+
+    def resolve_outlines():
+        start = time.perf_counter()
+        outlines = []
+        try:
+            outlines = get_outlines(doc, pageslist, pagesdict, columns)
+        except pdfminer.pdfdocument.PDFNoOutlines:
+            if emit_progress:
+                sys.stderr.write(
+                    "Document doesn't include outlines (\"bookmarks\")\n")
+        except Exception as ex:
+            sys.stderr.write("Warning: failed to retrieve outlines: %s\n" %
+                             ex)
+        if stats:
+            stats.add('outlines', time.perf_counter() - start)
+        return outlines
+
+    # resolved when the first annotation needs its section, while the
+    # document is still open
+    outlines = LazyOutlineIndex(resolve_outlines)
+    annots = iter_annotations(
+        doc, pageslist, emit_progress, engine, restrict, pagejobs, cache,
+        columns, path, stats, max_memory, reuse, delta, wanted)
+    return annots, outlines, getdocinfo(doc, len(pageslist))
+
+
+def process_file(fh, emit_progress, engine='python', restrict=False,
+                 pagejobs=1, cache=None, columns=COLUMNS_PER_PAGE, path=None):
+    """
+    Like extract_annotations, but returns the annotations and the outlines
+    (in reading order) as lists.
+    """
+    (annots, outlines, info) = extract_annotations(
+        fh, emit_progress, engine, restrict, pagejobs, cache, columns,
+        path=path)
+    return list(annots), outlines.outlines, info
 
 
 def parse_args():
     p = argparse.ArgumentParser(description=__doc__)
 
-    p.add_argument("input", metavar="INFILE", type=argparse.FileType("rb"),
-                   help="PDF files to process", nargs='+')
+    p.add_argument("input", metavar="INFILE",
+                   help="PDF files to process (\"-\" for standard input)",
+                   nargs='+')
 
     g = p.add_argument_group('Basic options')
     g.add_argument("-p", "--progress", default=False, action="store_true",
                    help="emit progress information")
+    g.add_argument(
+        "-j",
+        "--jobs",
+        default=1,
+        type=int,
+        metavar="N",
+        help="process up to N input files in parallel (default: 1)")
+    g.add_argument(
+        "--page-jobs",
+        dest="pagejobs",
+        default=1,
+        type=int,
+        metavar="N",
+        help=("process the pages of each input file in up to N parallel "
+              "processes; useful for very large documents, but all of a "
+              "file's annotations are then held in memory until its last "
+              "page is done (default: 1)"))
+    g.add_argument(
+        "--engine",
+        default="python",
+        choices=["python", "numpy"],
+        help=("how to match text to annotations: one character at a time, "
+              "or a whole page at once using NumPy (default: python)"))
+    g.add_argument(
+        "--restrict-layout",
+        dest="restrict",
+        default=False,
+        action="store_true",
+        help=("only analyse the layout of the lines of text near "
+              "annotations; faster on busy pages with few annotations"))
+    g.add_argument(
+        "--cache-dir",
+        metavar="DIR",
+        help=("cache the layout of annotated pages in DIR, so that only "
+              "changed pages need to be analysed again"))
+    g.add_argument(
+        "--cache-size",
+        default=256,
+        type=int,
+        metavar="MB",
+        help="maximum size of the layout cache (default: 256)")
+    g.add_argument(
+        "--max-memory",
+        type=int,
+        metavar="MB",
+        help=("keep memory use near MB on large documents, by dropping "
+              "pdfminer's parsed objects and fonts after any page that "
+              "leaves it above; slower, since they may be parsed again"))
+    g.add_argument(
+        "--stats",
+        metavar="FILE",
+        help=("append timings and counters for each annotated page and "
+              "each file to FILE as JSON lines (\"-\" for standard error)"))
+    g.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="run under cProfile, and save the profile to FILE")
     g.add_argument(
         "-n",
         "--cols",
@@ -618,6 +2173,15 @@ def parse_args():
         help="number of columns per page in the document (default: 2)")
 
     g = p.add_argument_group('Options controlling output format')
+    g.add_argument(
+        "-f",
+        "--format",
+        default="org",
+        choices=sorted(FORMATS),
+        help=("output format: org text, or one record per annotation as "
+              "JSON lines or a Parquet table, written to <basename>.jsonl "
+              "or .parquet; the section, grouping, filename and wrapping "
+              "options only affect org output (default: org)"))
     allsects = ["highlights", "comments", "nits"]
     g.add_argument(
         "-s",
@@ -629,12 +2193,50 @@ def parse_args():
         help=(
                 "sections to emit (default: %s)" %
                 ', '.join(allsects)))
+    g.add_argument(
+        "--pages",
+        metavar="RANGES",
+        help=("only extract annotations from these pages, e.g. 1-3,7,10- "
+              "(default: all)"))
+    g.add_argument(
+        "--subtype",
+        dest="subtypes",
+        metavar="TYPE",
+        nargs="+",
+        choices=sorted(ANNOT_SUBTYPES),
+        help="only extract annotations of these subtypes (%s)" %
+        ', '.join(sorted(ANNOT_SUBTYPES)))
+    g.add_argument(
+        "--author",
+        dest="authors",
+        metavar="NAME",
+        action="append",
+        help=("only extract annotations by this author, ignoring case; may "
+              "be given more than once"))
     g.add_argument(
         "--no-group",
         dest="group",
         default=True,
         action="store_false",
         help="emit annotations in order, don't group into sections")
+    g.add_argument(
+        "-o",
+        "--output-dir",
+        metavar="DIR",
+        help=("write outputs to DIR, and accept directories as inputs, "
+              "which are searched recursively for PDF files, and whose "
+              "outputs go in a subdirectory of DIR of the same name; a "
+              "manifest in "
+              "DIR is used to skip files unchanged since the last run, and "
+              "to remove the outputs of deleted files"))
+    g.add_argument(
+        "--delta",
+        default=False,
+        action="store_true",
+        help=("with --output-dir, also keep the annotations found in each "
+              "file, so that when a file has since only had updates "
+              "appended (as PDF editors do when saving a new comment), "
+              "only the pages they change are extracted again"))
     g.add_argument(
         "--print-filename",
         dest="printfilename",
@@ -644,29 +2246,1059 @@ def parse_args():
     g.add_argument("-w", "--wrap", metavar="COLS", type=int,
                    help="wrap text at this many output columns")
 
-    return p.parse_args()
+    args = p.parse_args()
+    if args.format == "parquet" and not have_pyarrow():
+        p.error("--format parquet requires PyArrow to be installed")
+    if args.engine == "numpy" and not have_numpy():
+        p.error("--engine numpy requires NumPy to be installed")
+    if args.cache_dir and args.restrict:
+        p.error("--cache-dir cannot be combined with --restrict-layout")
+    if args.max_memory is not None and args.max_memory < 1:
+        p.error("--max-memory must be at least 1")
+    if args.jobs < 1 or args.pagejobs < 1:
+        p.error("--jobs and --page-jobs must be at least 1")
+    if args.jobs > 1 and args.pagejobs > 1:
+        p.error("--jobs and --page-jobs cannot be combined")
+    if args.profile and (args.jobs > 1 or args.pagejobs > 1):
+        p.error("--profile cannot be combined with parallel jobs")
+    # files are opened one at a time as they are processed, but are checked
+    # up front so that a typo doesn't fail a long run part-way through
+    for path in args.input:
+        if path != '-' and not os.access(path, os.R_OK):
+            p.error("can't open '%s'" % path)
+        if os.path.isdir(path) and not args.output_dir:
+            p.error("'%s' is a directory, which requires --output-dir" % path)
+    if args.pages:
+        try:
+            parse_pages(args.pages)
+        except ValueError as ex:
+            p.error("--pages: %s" % ex)
+    if args.delta and not args.output_dir:
+        p.error("--delta requires --output-dir")
+    if args.output_dir and '-' in args.input:
+        p.error("--output-dir cannot be used when reading from standard "
+                "input")
+    if (args.jobs > 1 or args.pagejobs > 1) and '-' in args.input:
+        p.error("parallel jobs cannot be used when reading from standard "
+                "input")
+    return args
+
+
+# output file extension of each --format
+FORMATS = {'org': '.org', 'jsonl': '.jsonl', 'parquet': '.parquet'}
+
+OUTPUT_BUFFER = 1024 * 1024  # bytes buffered when writing outputs
+
+
+def write_org(path, args, orgpath=None, delta=None):
+    """
+    Extracts the annotations of one PDF file ("-" for standard input) into
+    orgpath, by default <basename>.org (or the extension of args.format) in
+    the current directory. Also the entry point of worker processes.
+    Returns the number of annotations.
 
+    delta  If not None, a Delta for extract_annotations
+    """
+    cache = None
+    if args.cache_dir:
+        cache = GlyphCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    name = '<stdin>' if path == '-' else path
+    stats = Stats(name, args.stats) if args.stats else None
+    if orgpath is None:
+        orgpath = (os.path.splitext(os.path.basename(name))[0] +
+                   FORMATS[args.format])
+    if args.format == 'org':
+        mode = dict(mode='w')
+    elif args.format == 'jsonl':
+        mode = dict(mode='w', encoding='utf-8', buffering=OUTPUT_BUFFER)
+    else:
+        mode = dict(mode='wb')
+    with open_input(path) as fh:
+        (annots, outlines, info) = extract_annotations(
+            fh, args.progress, args.engine, args.restrict, args.pagejobs,
+            cache, args.cols, stats, path,
+            args.max_memory * 1024 if args.max_memory else None, delta,
+            AnnotationFilter.from_args(args))
+        with atomic_write(orgpath, **mode) as orgfile:
+            nannots = write_annots(annots, outlines, info, name, args,
+                                   orgfile)
+    if stats:
+        stats.finish()
+    return nannots
+
+
+def write_annots(annots, outlines, info, filename, args, orgfile):
+    """
+    Prints the annotations to orgfile in args.format. Returns their number.
+    """
+    if args.format == 'jsonl':
+        return JsonLinesPrinter(outlines, orgfile).printall(annots)
+    elif args.format == 'parquet':
+        return ParquetPrinter(outlines, orgfile).printall(annots)
+
+    op = OrgPrinter(outlines, args.wrap, orgfile)
+    if args.printfilename:
+        # the title is only printed if there are annotations
+        first = next(annots, None)
+        if first is None:
+            return 0
+        print(f"#+Title: {info.title if info.title else filename}\n",
+              file=orgfile)
+        annots = itertools.chain([first], annots)
+    if args.group:
+        return op.printall_grouped(args.sections, annots)
+    else:
+        return op.printall(annots)
 
-def main():
-    args = parse_args()
-    global COLUMNS_PER_PAGE
-    COLUMNS_PER_PAGE = args.cols
-    for file in args.input:
-        (annots, outlines) = process_file(file, args.progress)
-        orgfilename = os.path.splitext(os.path.basename(file.name))[0]
-        orgfile = open(orgfilename + '.org', 'w')
-        op = OrgPrinter(outlines, args.wrap, orgfile)
-        title = pdftitle(file)
-        if args.printfilename and annots:
-            print(f"#+Title: {title if title else file.name}\n", file=orgfile)
-        if args.group:
-            op.printall_grouped(args.sections, annots)
+
+def run_jobs(fn, calls, jobs):
+    """
+    Calls fn(*args) for each args in calls, in a pool of worker processes if
+    jobs > 1. Yields (args, result, exception) as each call completes.
+    """
+    if jobs == 1:
+        for args in calls:
+            try:
+                yield args, fn(*args), None
+            except Exception as ex:
+                yield args, None, ex
+        return
+
+    import concurrent.futures
+
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        futures = {pool.submit(fn, *args): args for args in calls}
+        for future in concurrent.futures.as_completed(futures):
+            ex = future.exception()
+            yield futures[future], None if ex else future.result(), ex
+
+
+def worker_options(args):
+    """
+    Returns a copy of the options for worker processes. Per-page progress
+    from concurrent workers would be interleaved, so workers stay quiet and
+    progress is reported per file instead.
+    """
+    options = argparse.Namespace(**vars(args))
+    del options.input
+    if args.jobs > 1:
+        options.progress = False
+    return options
+
+
+def write_org_parallel(args):
+    """
+    Runs write_org for each input file in a pool of args.jobs worker
+    processes, reporting but otherwise ignoring failures.
+    Returns the number of files that failed.
+    """
+    paths = args.input
+    options = worker_options(args)
+
+    failed = []
+    done = run_jobs(write_org, [(path, options) for path in paths], args.jobs)
+    for (n, ((path, _), nannots, ex)) in enumerate(done, 1):
+        if ex is not None:
+            failed.append(path)
+            sys.stderr.write("[%d/%d] %s: error: %s\n" %
+                             (n, len(paths), path, ex))
+        elif args.progress:
+            sys.stderr.write("[%d/%d] %s: %d annotations\n" %
+                             (n, len(paths), path, nannots))
+
+    if args.progress or failed:
+        sys.stderr.write("Processed %d files, %d failed\n" %
+                         (len(paths), len(failed)))
+        for path in failed:
+            sys.stderr.write("  failed: %s\n" % path)
+    return len(failed)
+
+
+def file_digest(path, prefix=None):
+    """
+    Returns the SHA-256 digest of a file's contents, in hex; or if prefix is
+    not None, a pair of that and the digest of the first prefix bytes.
+    """
+    h = hashlib.sha256()
+    prefixh = None
+    with open_input(path) as fh:
+        if isinstance(fh, mmap.mmap):
+            with memoryview(fh) as view:
+                if prefix is not None:
+                    h.update(view[:prefix])
+                    prefixh = h.copy()
+                    h.update(view[prefix:])
+                else:
+                    h.update(view)
         else:
-            op.printall(annots)
-        orgfile.close()
+            if prefix is not None:
+                h.update(fh.read(prefix))
+                prefixh = h.copy()
+            for block in iter(lambda: fh.read(1024 * 1024), b''):
+                h.update(block)
+    if prefix is None:
+        return h.hexdigest()
+    return h.hexdigest(), prefixh.hexdigest()
+
+
+def write_org_changed(path, orgpath, digest, statepath, args):
+    """
+    Entry point of worker processes in --output-dir mode: like write_org,
+    unless the file's contents still have the given digest. Returns (size,
+    mtime, digest, number of annotations or None if unchanged).
+
+    statepath  If not None, the file of the Delta of path, which is used
+               if the file has only grown by appended updates since it was
+               saved, and is saved again
+    """
+    st = os.stat(path)
+    delta = None
+    if statepath is not None:
+        delta = Delta.load(statepath)
+    if (delta is not None and delta.digest is not None and
+            delta.digest == digest and delta.size < st.st_size):
+        (newdigest, prefixdigest) = file_digest(path, delta.size)
+        if prefixdigest != delta.digest:
+            delta = Delta()  # rewritten, not just appended to
+    else:
+        newdigest = file_digest(path)
+        if delta is not None:
+            delta = Delta()
+
+    nannots = None
+    if newdigest != digest:
+        os.makedirs(os.path.dirname(orgpath) or '.', exist_ok=True)
+        nannots = write_org(path, args, orgpath, delta)
+        if delta is not None:
+            (delta.size, delta.digest) = (st.st_size, newdigest)
+            delta.save(statepath)
+    return st.st_size, st.st_mtime_ns, newdigest, nannots
+
+
+class Manifest:
+    """
+    Record of the inputs from which the outputs in an --output-dir were
+    produced, with the options that affect the output, saved as JSON in the
+    directory.
+    """
+
+    FILENAME = '.pdfannots-manifest.json'
+    STATEDIR = '.pdfannots-delta'  # holds the Delta of each input
+    VERSION = 1
+
+    # options that change the output, so that outputs produced with others
+    # must be produced again
+    OPTIONS = ('format', 'sections', 'group', 'printfilename', 'wrap', 'cols',
+               'engine', 'restrict', 'pages', 'subtypes', 'authors')
+
+    def __init__(self, outdir, args):
+        self.outdir = outdir
+        self.filename = os.path.join(outdir, self.FILENAME)
+        self.options = {k: getattr(args, k) for k in self.OPTIONS}
+        # absolute input path -> its size, mtime and digest, and the path of
+        # its output relative to outdir
+        self.files = {}
+        self.current = True  # were the recorded outputs made with options?
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as ex:
+            sys.stderr.write("Warning: ignoring invalid manifest %s: %s\n" %
+                             (self.filename, ex))
+            return
+        if data.get('version') == self.VERSION:
+            self.files = data['files']
+            self.current = data['options'] == self.options
+
+    def _entry(self, path, orgpath):
+        """The entry of path, if its recorded output is still valid."""
+        entry = self.files.get(os.path.abspath(path))
+        if (self.current and entry and
+                entry['output'] == os.path.relpath(orgpath, self.outdir) and
+                os.path.exists(orgpath)):
+            return entry
+        return None
+
+    def unchanged(self, path, orgpath):
+        """
+        Is the output of path up to date, judging by its size and
+        modification time alone?
+        """
+        entry = self._entry(path, orgpath)
+        if entry is None:
+            return False
+        st = os.stat(path)
+        return (entry['size'] == st.st_size and
+                entry['mtime'] == st.st_mtime_ns)
+
+    def digest(self, path, orgpath):
+        """The last digest of path, if its output is still valid."""
+        entry = self._entry(path, orgpath)
+        return entry['digest'] if entry else None
+
+    def statepath(self, path):
+        """The file in which the Delta of path is kept."""
+        name = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()
+        return os.path.join(self.outdir, self.STATEDIR, name + '.json')
+
+    def record(self, path, orgpath, size, mtime, digest):
+        path = os.path.abspath(path)
+        output = os.path.relpath(orgpath, self.outdir)
+        old = self.files.get(path)
+        self.files[path] = dict(output=output, size=size, mtime=mtime,
+                                digest=digest)
+        if old and old['output'] != output:
+            # e.g. written to another name before the layout changed
+            self._remove_output(old['output'])
+
+    def _remove_output(self, output):
+        """Removes an output, unless an input still has it."""
+        if any(entry['output'] == output for entry in self.files.values()):
+            return
+        try:
+            os.unlink(os.path.join(self.outdir, output))
+        except FileNotFoundError:
+            pass
+
+    def remove_deleted(self):
+        """
+        Removes the outputs of inputs that no longer exist, and forgets them.
+        Returns the number removed.
+        """
+        deleted = [path for path in self.files if not os.path.exists(path)]
+        for path in deleted:
+            self._remove_output(self.files.pop(path)['output'])
+            try:
+                os.unlink(self.statepath(path))
+            except FileNotFoundError:
+                pass
+        return len(deleted)
+
+    def save(self):
+        with atomic_write(self.filename) as f:
+            json.dump(dict(version=self.VERSION, options=self.options,
+                           files=self.files), f)
+
+
+def find_inputs(paths, outdir, ext):
+    """
+    Yields (input path, output path) for each named file, and for each PDF
+    file found by recursively searching the named directories. Each named
+    directory has a subdirectory of outdir with the same name, below which
+    outputs mirror its directory structure.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            base = os.path.splitext(os.path.basename(path))[0]
+            yield path, os.path.join(outdir, base + ext)
+            continue
+        top = os.path.basename(os.path.abspath(path))
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.lower().endswith('.pdf'):
+                    inpath = os.path.join(dirpath, name)
+                    rel = os.path.relpath(inpath, path)
+                    yield inpath, os.path.join(
+                        outdir, top, os.path.splitext(rel)[0] + ext)
+
+
+def clashing_outputs(inputs):
+    """
+    Returns a list of (output path, input paths) for each output path that
+    more than one of the distinct inputs in the (input, output) pairs of
+    inputs would be written to.
+    """
+    sources = defaultdict(set)
+    for (path, orgpath) in inputs:
+        sources[orgpath].add(os.path.abspath(path))
+    return [(orgpath, sorted(paths)) for (orgpath, paths) in sources.items()
+            if len(paths) > 1]
 
+
+def write_org_dir(args):
+    """
+    Processes the input files and directories into args.output_dir, skipping
+    files unchanged since the last run according to the manifest there, and
+    removing the outputs of deleted files. Reports but otherwise ignores
+    failures. Returns the number of files that failed.
+    """
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest = Manifest(args.output_dir, args)
+    options = worker_options(args)
+
+    inputs = list(find_inputs(args.input, args.output_dir,
+                              FORMATS[args.format]))
+    clashes = clashing_outputs(inputs)
+    if clashes:
+        for (orgpath, paths) in clashes:
+            sys.stderr.write("error: %s would be written to %s\n" %
+                             (' and '.join(paths), orgpath))
+        return len(inputs)
+    # an input named more than once is processed once
+    inputs = list({os.path.abspath(path): (path, orgpath)
+                   for (path, orgpath) in inputs}.values())
+    calls = [(path, orgpath, manifest.digest(path, orgpath),
+              manifest.statepath(path) if args.delta else None, options)
+             for (path, orgpath) in inputs
+             if not manifest.unchanged(path, orgpath)]
+    skipped = len(inputs) - len(calls)
+
+    failed = []
+    try:
+        done = run_jobs(write_org_changed, calls, args.jobs)
+        for (n, ((path, orgpath, *_), result, ex)) in enumerate(done, 1):
+            if ex is not None:
+                failed.append(path)
+                sys.stderr.write("[%d/%d] %s: error: %s\n" %
+                                 (n, len(calls), path, ex))
+                continue
+            (size, mtime, digest, nannots) = result
+            manifest.record(path, orgpath, size, mtime, digest)
+            if nannots is None:
+                skipped += 1
+            elif args.progress:
+                sys.stderr.write("[%d/%d] %s: %d annotations\n" %
+                                 (n, len(calls), path, nannots))
+        removed = manifest.remove_deleted()
+    finally:
+        # keep what was done, even if interrupted
+        manifest.save()
+
+    sys.stderr.write(
+        "Processed %d files, skipped %d unchanged, %d failed, removed %d "
+        "outputs of deleted files\n" % (
+            len(inputs) - skipped - len(failed), skipped, len(failed),
+            removed))
+    for path in failed:
+        sys.stderr.write("  failed: %s\n" % path)
+    return len(failed)
+
+
+# options a serve request may set, with their defaults
+SERVE_OPTIONS = dict(format='org', sections=["highlights", "comments", "nits"],
+                     cols=2, wrap=None, group=True, printfilename=False,
+                     engine='python', restrict=False, pages=None,
+                     subtypes=None, authors=None)
+
+
+def is_int(value):
+    # JSON true and false are bools, which are ints to Python
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def is_strings(value):
+    return isinstance(value, list) and all(isinstance(v, str) for v in value)
+
+
+# checks of the type of each option of a serve request, with a description
+# of what passes them for the error
+SERVE_OPTION_TYPES = dict(
+    path=(lambda v: isinstance(v, str), "a string"),
+    format=(lambda v: isinstance(v, str), "a string"),
+    sections=(is_strings, "a list of strings"),
+    cols=(lambda v: is_int(v) and v >= 1, "an integer of at least 1"),
+    wrap=(lambda v: v is None or is_int(v), "an integer or null"),
+    group=(lambda v: isinstance(v, bool), "true or false"),
+    printfilename=(lambda v: isinstance(v, bool), "true or false"),
+    engine=(lambda v: isinstance(v, str), "a string"),
+    restrict=(lambda v: isinstance(v, bool), "true or false"),
+    pages=(lambda v: v is None or isinstance(v, str), "a string or null"),
+    subtypes=(lambda v: v is None or is_strings(v),
+              "a list of strings or null"),
+    authors=(lambda v: v is None or is_strings(v),
+             "a list of strings or null"))
+
+
+def check_serve_options(options):
+    """Raises ValueError unless each of the options has the right type."""
+    for (name, (check, what)) in SERVE_OPTION_TYPES.items():
+        if not check(getattr(options, name)):
+            raise ValueError("%s must be %s" % (name, what))
+
+
+def serve_request(request):
+    """
+    Handles one request of the serve protocol: extracts the annotations of
+    request['path'], and returns them as org text or as JSON-ready records.
+    """
+    if not isinstance(request, dict) or 'path' not in request:
+        raise ValueError("request must be an object with a path")
+    unknown = set(request) - set(SERVE_OPTIONS) - {'path'}
+    if unknown:
+        raise ValueError("unknown options: %s" % ', '.join(sorted(unknown)))
+    options = argparse.Namespace(**dict(SERVE_OPTIONS, **request))
+    check_serve_options(options)
+    if options.format not in ('org', 'json'):
+        raise ValueError("format must be org or json")
+    if not set(options.sections) <= set(SERVE_OPTIONS['sections']):
+        raise ValueError("sections must be among %s" %
+                         ', '.join(SERVE_OPTIONS['sections']))
+    if options.engine not in EXTRACTORS:
+        raise ValueError("engine must be among %s" % ', '.join(EXTRACTORS))
+    if options.subtypes is not None and not set(options.subtypes) <= \
+            ANNOT_SUBTYPES:
+        raise ValueError("subtypes must be among %s" %
+                         ', '.join(sorted(ANNOT_SUBTYPES)))
+    wanted = AnnotationFilter.from_args(options)
+
+    with open_input(options.path) as fh:
+        (annots, outlines, info) = extract_annotations(
+            fh, False, options.engine, options.restrict, 1, None,
+            options.cols, wanted=wanted)
+        if options.format == 'json':
+            return {'annots': [annotation_record(a, outlines)
+                               for a in annots]}
+
+        out = io.StringIO()
+        nannots = write_annots(annots, outlines, info, options.path, options,
+                               out)
+        return {'annots': nannots, 'org': out.getvalue()}
+
+
+def serve_worker(conn):
+    """
+    Entry point of serve worker processes: handles requests received on conn
+    until it is closed.
+    """
+    # interrupts are for the server, which shuts down its workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # import pdfminer now, not while the first request waits
+    make_extractor('python', False, {})
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        try:
+            response = dict(ok=True, **serve_request(request))
+        except Exception as ex:
+            response = dict(ok=False, error=str(ex))
+        conn.send(response)
+
+
+class ServeWorker:
+    """A worker process of the server, and the pipe to it."""
+
+    def __init__(self):
+        import multiprocessing
+
+        # workers are replaced from the server's handler threads, which must
+        # not fork, so they are started by a single-threaded fork server
+        context = multiprocessing.get_context('forkserver')
+        (self.conn, child) = context.Pipe()
+        self.process = context.Process(
+            target=serve_worker, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+
+    def call(self, request, timeout):
+        """
+        Returns the worker's response to request. Raises TimeoutError if there
+        is none within timeout seconds, or EOFError if the worker died.
+        """
+        self.conn.send(request)
+        if not self.conn.poll(timeout):
+            raise TimeoutError
+        return self.conn.recv()
+
+    def close(self):
+        self.conn.close()
+        self.process.kill()
+        self.process.join()
+
+
+class ServePool:
+    """
+    A fixed number of long-lived worker processes, which keep pdfminer's
+    imports and caches warm from one request to the next. A worker that
+    exceeds the timeout is killed and replaced.
+    """
+
+    def __init__(self, jobs, backlog, timeout):
+        """
+        jobs     Number of worker processes, hence of concurrent requests
+        backlog  Number of requests that may wait for a worker before further
+                 ones are rejected
+        timeout  Seconds after which a request is abandoned
+        """
+        self.timeout = timeout
+        self.limit = jobs + backlog
+        self.active = 0  # requests running or waiting
+        self.lock = threading.Lock()
+        self.idle = queue.Queue()
+        for _ in range(jobs):
+            self.idle.put(ServeWorker())
+        self.nworkers = jobs
+
+    def run(self, request):
+        with self.lock:
+            if self.active >= self.limit:
+                return dict(ok=False, error="server busy")
+            self.active += 1
+        try:
+            worker = self.idle.get()
+            try:
+                return worker.call(request, self.timeout)
+            except TimeoutError:
+                worker.close()
+                worker = ServeWorker()
+                return dict(ok=False, error="timed out after %g seconds" %
+                            self.timeout)
+            except (EOFError, OSError):
+                worker.close()
+                worker = ServeWorker()
+                return dict(ok=False, error="worker process died")
+            finally:
+                self.idle.put(worker)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def close(self):
+        for _ in range(self.nworkers):
+            self.idle.get().close()
+
+
+class ServeHandler(socketserver.StreamRequestHandler):
+    """
+    Reads requests from a connection, one JSON object per line, and writes a
+    JSON response line for each in turn.
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as ex:
+                response = dict(ok=False, error="invalid JSON: %s" % ex)
+            else:
+                response = self.server.pool.run(request)
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+
+def parse_serve_args(argv):
+    p = argparse.ArgumentParser(
+        prog="%s serve" % os.path.basename(sys.argv[0]),
+        description=(
+            "Serve extraction requests on a Unix domain socket. Each request "
+            "is a line of JSON with the path of a PDF file, and optionally "
+            "format (org or json), %s; each response is a line of JSON "
+            "with ok set, and either the org text or annotation records, or "
+            "an error. The json format has every annotation that pages, "
+            "subtypes and authors select, irrespective of the options "
+            "controlling org output." %
+            ', '.join(k for k in SERVE_OPTIONS if k != 'format')))
+    p.add_argument("socket", metavar="SOCKET",
+                   help="path of the socket to listen on")
+    p.add_argument("-j", "--jobs", default=os.cpu_count() or 1, type=int,
+                   metavar="N",
+                   help="number of worker processes, hence of concurrent "
+                   "requests (default: number of CPUs)")
+    p.add_argument("--backlog", default=16, type=int, metavar="N",
+                   help="number of requests that may wait for a worker, "
+                   "beyond which requests are rejected (default: 16)")
+    p.add_argument("--timeout", default=60, type=float, metavar="SECONDS",
+                   help="abandon requests that take longer than this, "
+                   "killing their worker (default: 60)")
+    args = p.parse_args(argv)
+    if args.jobs < 1 or args.backlog < 0 or args.timeout <= 0:
+        p.error("--jobs and --timeout must be positive, and --backlog must "
+                "not be negative")
+    return args
+
+
+def serve(argv):
+    args = parse_serve_args(argv)
+    pool = ServePool(args.jobs, args.backlog, args.timeout)
+
+    # workers are started before the socket exists, so don't inherit it; it
+    # is created with no permissions for others, so only the owner may send
+    # requests
+    umask = os.umask(0o177)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(args.socket,
+                                                        ServeHandler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    server.pool = pool
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+        pool.close()
+    return 0
+
+
+class AnnotationIndex:
+    """
+    SQLite database of the annotations of a library of PDF files, for the
+    index and query subcommands, with an FTS5 full-text index of their text,
+    contents, outline titles and authors.
+    """
+
+    VERSION = 1
+
+    # options that change the rows extracted, so that files indexed with
+    # others must be indexed again
+    OPTIONS = ('cols', 'engine', 'restrict')
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE NOT NULL,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            digest TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS annots (
+            id INTEGER PRIMARY KEY,
+            file INTEGER NOT NULL REFERENCES files (id),
+            page INTEGER NOT NULL,
+            subtype TEXT NOT NULL,
+            author TEXT,
+            text TEXT,
+            contents TEXT,
+            outline TEXT);
+        CREATE INDEX IF NOT EXISTS annots_file ON annots (file);
+        CREATE VIRTUAL TABLE IF NOT EXISTS annots_fts USING fts5 (
+            text, contents, outline, author,
+            content='annots', content_rowid='id');
+        CREATE TRIGGER IF NOT EXISTS annots_insert AFTER INSERT ON annots
+        BEGIN
+            INSERT INTO annots_fts (rowid, text, contents, outline, author)
+            VALUES (new.id, new.text, new.contents, new.outline, new.author);
+        END;
+        CREATE TRIGGER IF NOT EXISTS annots_delete AFTER DELETE ON annots
+        BEGIN
+            INSERT INTO annots_fts (annots_fts, rowid, text, contents,
+                                    outline, author)
+            VALUES ('delete', old.id, old.text, old.contents, old.outline,
+                    old.author);
+        END;
+    """
+
+    def __init__(self, filename):
+        import sqlite3
+
+        self.db = sqlite3.connect(filename)
+        with self.db:
+            self.db.executescript(self.SCHEMA)
+            version = self.meta('version')
+            if version is None:
+                self.set_meta('version', self.VERSION)
+            elif version != self.VERSION:
+                raise ValueError("%s is an index of another version (%s)" %
+                                 (filename, version))
+
+    def meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?',
+                              (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                        (key, json.dumps(value)))
+
+    def use_options(self, args):
+        """
+        Records the options in args, forgetting every file if they differ
+        from those the index was made with.
+        """
+        options = {k: getattr(args, k) for k in self.OPTIONS}
+        if self.meta('options') != options:
+            with self.db:
+                self.db.execute('DELETE FROM annots')
+                self.db.execute('DELETE FROM files')
+                self.set_meta('options', options)
+
+    def entry(self, path):
+        """Returns (size, mtime, digest) of the indexed path, or None."""
+        return self.db.execute(
+            'SELECT size, mtime, digest FROM files WHERE path = ?',
+            (os.path.abspath(path),)).fetchone()
+
+    def record(self, path, size, mtime, digest, rows):
+        """
+        Records the current size, mtime and digest of path, and if rows is
+        not None, replaces its annotations with rows of (page, subtype,
+        author, text, contents, outline).
+        """
+        path = os.path.abspath(path)
+        with self.db:
+            if rows is None:
+                self.db.execute(
+                    'UPDATE files SET size = ?, mtime = ? WHERE path = ?',
+                    (size, mtime, path))
+                return
+            self.delete(path)
+            fileid = self.db.execute(
+                'INSERT INTO files (path, size, mtime, digest) '
+                'VALUES (?, ?, ?, ?)', (path, size, mtime, digest)).lastrowid
+            self.db.executemany(
+                'INSERT INTO annots (file, page, subtype, author, text, '
+                'contents, outline) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(fileid,) + row for row in rows])
+
+    def delete(self, path):
+        self.db.execute('DELETE FROM annots WHERE file IN '
+                        '(SELECT id FROM files WHERE path = ?)', (path,))
+        self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+
+    def remove_deleted(self):
+        """Forgets files that no longer exist. Returns their number."""
+        deleted = [path for (path,) in self.db.execute(
+            'SELECT path FROM files') if not os.path.exists(path)]
+        with self.db:
+            for path in deleted:
+                self.delete(path)
+        return len(deleted)
+
+    def search(self, match, subtypes=None, authors=None, limit=None):
+        """
+        Yields (path, page, subtype, author, text, contents, outline,
+        digest) for each annotation matching the FTS5 query match, best
+        matches first.
+
+        subtypes  If not None, only annotations of these subtypes
+        authors   If not None, only annotations by these authors, ignoring
+                  case
+        """
+        sql = ('SELECT files.path, annots.page, annots.subtype, '
+               'annots.author, annots.text, annots.contents, annots.outline, '
+               'files.digest FROM annots_fts '
+               'JOIN annots ON annots.id = annots_fts.rowid '
+               'JOIN files ON files.id = annots.file '
+               'WHERE annots_fts MATCH ?')
+        params = [match]
+        if subtypes is not None:
+            sql += ' AND annots.subtype IN (%s)' % ', '.join('?' * len(
+                subtypes))
+            params += subtypes
+        if authors is not None:
+            # SQLite's lower() only folds ASCII
+            self.db.create_function(
+                'casefold', 1, lambda s: s.casefold() if s else s,
+                deterministic=True)
+            sql += ' AND casefold(annots.author) IN (%s)' % ', '.join(
+                '?' * len(authors))
+            params += [a.casefold() for a in authors]
+        sql += ' ORDER BY annots_fts.rank'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        yield from self.db.execute(sql, params)
+
+    def close(self):
+        self.db.close()
+
+
+def index_file(path, digest, args):
+    """
+    Entry point of worker processes for the index subcommand: extracts the
+    annotations of path as rows for AnnotationIndex.record, unless the
+    file's contents still have the given digest. Returns (size, mtime,
+    digest, rows or None if unchanged).
+    """
+    st = os.stat(path)
+    newdigest = file_digest(path)
+    rows = None
+    if newdigest != digest:
+        rows = []
+        with open_input(path) as fh:
+            (annots, outlines, _) = extract_annotations(
+                fh, False, args.engine, args.restrict, 1, None, args.cols,
+                path=path)
+            for a in annots:
+                r = annotation_record(a, outlines)
+                rows.append((r['page'], r['subtype'], r['author'], r['text'],
+                             r['contents'], r['outline']))
+    return st.st_size, st.st_mtime_ns, newdigest, rows
+
+
+def parse_index_args(argv):
+    p = argparse.ArgumentParser(
+        prog="%s index" % os.path.basename(sys.argv[0]),
+        description=(
+            "Extract the annotations of PDF files into a SQLite database "
+            "with a full-text index, for the query subcommand. Files "
+            "unchanged since they were last indexed are skipped, and files "
+            "that no longer exist are removed."))
+    p.add_argument("database", metavar="DB", help="the database file")
+    p.add_argument("input", metavar="INPUT", nargs='+',
+                   help="PDF files, or directories to search recursively "
+                   "for PDF files")
+    p.add_argument("-p", "--progress", default=False, action="store_true",
+                   help="report each file indexed")
+    p.add_argument("-j", "--jobs", default=1, type=int, metavar="N",
+                   help="process up to N files in parallel (default: 1)")
+    p.add_argument("--engine", default="python", choices=sorted(EXTRACTORS),
+                   help="how to match text to annotations (default: python)")
+    p.add_argument("--restrict-layout", dest="restrict", default=False,
+                   action="store_true",
+                   help="only analyse the layout of text near annotations")
+    p.add_argument("-n", "--cols", default=2, type=int, metavar="COLS",
+                   help="number of columns per page in the documents "
+                   "(default: 2)")
+    args = p.parse_args(argv)
+    if args.jobs < 1:
+        p.error("--jobs must be at least 1")
+    if args.engine == "numpy" and not have_numpy():
+        p.error("--engine numpy requires NumPy to be installed")
+    for path in args.input:
+        if not os.access(path, os.R_OK):
+            p.error("can't open '%s'" % path)
+    return args
+
+
+def index(argv):
+    """
+    The index subcommand. Reports but otherwise ignores files that fail.
+    Returns the exit status.
+    """
+    args = parse_index_args(argv)
+    db = AnnotationIndex(args.database)
+    db.use_options(args)
+
+    inputs = [path for (path, _) in find_inputs(args.input, '', '')]
+    calls = []
+    for path in inputs:
+        entry = db.entry(path)
+        st = os.stat(path)
+        if entry and entry[:2] == (st.st_size, st.st_mtime_ns):
+            continue
+        calls.append((path, entry[2] if entry else None, args))
+    skipped = len(inputs) - len(calls)
+
+    failed = []
+    try:
+        done = run_jobs(index_file, calls, args.jobs)
+        for (n, ((path, _, _), result, ex)) in enumerate(done, 1):
+            if ex is not None:
+                failed.append(path)
+                sys.stderr.write("[%d/%d] %s: error: %s\n" %
+                                 (n, len(calls), path, ex))
+                continue
+            (size, mtime, digest, rows) = result
+            db.record(path, size, mtime, digest, rows)
+            if rows is None:
+                skipped += 1
+            elif args.progress:
+                sys.stderr.write("[%d/%d] %s: %d annotations\n" %
+                                 (n, len(calls), path, len(rows)))
+        removed = db.remove_deleted()
+    finally:
+        db.close()
+
+    sys.stderr.write(
+        "Indexed %d files, skipped %d unchanged, %d failed, removed %d "
+        "deleted files\n" % (len(inputs) - skipped - len(failed), skipped,
+                             len(failed), removed))
+    for path in failed:
+        sys.stderr.write("  failed: %s\n" % path)
+    return 1 if failed else 0
+
+
+def parse_query_args(argv):
+    p = argparse.ArgumentParser(
+        prog="%s query" % os.path.basename(sys.argv[0]),
+        description=(
+            "Search the annotations in a database made by the index "
+            "subcommand, best matches first. The query is in SQLite's FTS5 "
+            "syntax, and may be restricted to one of the columns text, "
+            "contents, outline or author, e.g. 'contents: baseline'."))
+    p.add_argument("database", metavar="DB", help="the database file")
+    p.add_argument("query", metavar="QUERY", help="full-text query")
+    p.add_argument("--subtype", dest="subtypes", metavar="TYPE", nargs="+",
+                   choices=sorted(ANNOT_SUBTYPES),
+                   help="only annotations of these subtypes")
+    p.add_argument("--author", dest="authors", metavar="NAME",
+                   action="append",
+                   help="only annotations by this author, ignoring case; may "
+                   "be given more than once")
+    p.add_argument("--limit", type=int, metavar="N",
+                   help="print at most N annotations")
+    p.add_argument("--json", default=False, action="store_true",
+                   help="print each annotation as a line of JSON")
+    args = p.parse_args(argv)
+    if not os.path.exists(args.database):
+        p.error("can't open '%s'" % args.database)
+    return args
+
+
+def query(argv):
+    """The query subcommand. Returns the exit status."""
+    import sqlite3
+
+    args = parse_query_args(argv)
+    db = AnnotationIndex(args.database)
+    fields = ('path', 'page', 'subtype', 'author', 'text', 'contents',
+              'outline', 'digest')
+    try:
+        for row in db.search(args.query, args.subtypes, args.authors,
+                             args.limit):
+            if args.json:
+                print(json.dumps(dict(zip(fields, row)), ensure_ascii=False))
+                continue
+            (path, page, subtype, author, text, contents, outline, _) = row
+            print("%s:%d: %s%s%s" % (
+                path, page, subtype, " by %s" % author if author else "",
+                " in %s" % outline if outline else ""))
+            if text:
+                print("  > %s" % text)
+            if contents:
+                print(textwrap.indent(contents, "  "))
+    except sqlite3.OperationalError as ex:
+        # e.g. a syntax error in the query
+        sys.stderr.write("error: %s\n" % ex)
+        return 1
+    finally:
+        db.close()
     return 0
 
 
+def main():
+    if sys.argv[1:2] == ['serve']:
+        return serve(sys.argv[2:])
+    if sys.argv[1:2] == ['index']:
+        return index(sys.argv[2:])
+    if sys.argv[1:2] == ['query']:
+        return query(sys.argv[2:])
+
+    args = parse_args()
+    if args.jobs > 1 and not args.output_dir:
+        return 1 if write_org_parallel(args) else 0
+
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    status = 0
+    try:
+        if args.output_dir:
+            status = 1 if write_org_dir(args) else 0
+        else:
+            for path in args.input:
+                write_org(path, args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+    return status
+
+
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,237 @@
+"""
+Tests of pdfannots.py, run with pytest. The documents they extract are
+generated by benchmark.synthetic_pdf().
+"""
+
+import gc
+import io
+import re
+import tracemalloc
+
+import pytest
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+from pdfminer.psparser import LIT
+
+import benchmark
+import pdfannots
+
+FONT = 4  # object ID of the font of every page of a synthetic_pdf()
+
+MEMORY_TOLERANCE = 0.2  # allowed growth of peak memory with --max-memory
+
+
+def append_update(data, objs):
+    """
+    Returns the document data with an incremental update appended, which
+    replaces or adds the objects of objs, a map from object ID to source.
+    """
+    prev = int(data.rsplit(b"startxref", 1)[1].split()[0])
+    size = int(re.findall(rb"/Size (\d+)", data)[-1])
+    root = re.findall(rb"/Root (\d+) 0 R", data)[-1]
+    out = io.BytesIO()
+    out.write(data)
+    offsets = {}
+    for (objid, source) in sorted(objs.items()):
+        offsets[objid] = out.tell()
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (
+            objid, source.encode("latin-1")))
+    startxref = out.tell()
+    out.write(b"xref\n")
+    for (objid, offset) in offsets.items():
+        out.write(b"%d 1\n%010d 00000 n \n" % (objid, offset))
+    out.write(b"trailer\n<< /Size %d /Root %s 0 R /Prev %d >>\n"
+              b"startxref\n%d\n%%%%EOF\n" % (
+                  max(size, max(objs) + 1), root, prev, startxref))
+    return out.getvalue()
+
+
+def changed_pages(data, size):
+    """Numbers of the pages that page_changed() finds updated past size."""
+    doc = PDFDocument(PDFParser(io.BytesIO(data)))
+    changed = pdfannots.appended_objects(doc, size)
+    memo = {}
+    return [pageno for (pageno, pdfpage)
+            in enumerate(PDFPage.create_pages(doc))
+            if pdfannots.page_changed(pdfpage, changed, memo)]
+
+
+def extract(data, delta=None, **options):
+    """
+    Returns the text of each annotation of the document, in order, extracted
+    with further options as for extract_annotations().
+    """
+    (annots, _, _) = pdfannots.extract_annotations(
+        io.BytesIO(data), False, delta=delta, **options)
+    texts = [a.gettext() for a in annots]
+    if delta is not None:
+        delta.size = len(data)
+    return texts
+
+
+def test_unwanted_subtype_not_decoded():
+    class Undecodable:
+        def __getattr__(self, name):
+            raise AssertionError("decoded")
+
+    page = pdfannots.Page(0, (0, 0, 612, 792))
+    pa = {'Subtype': LIT('Highlight'), 'T': Undecodable(),
+          'Contents': Undecodable(), 'Rect': [0, 0, 10, 10]}
+    for wanted in (pdfannots.AnnotationFilter(subtypes=['Text']),
+                   pdfannots.AnnotationFilter(sections=['nits'],
+                                              subtypes=['Squiggly'])):
+        assert pdfannots.getannots([pa], page, wanted=wanted) == []
+
+
+def test_ungrouped_org(tmp_path):
+    path = tmp_path / "doc.pdf"
+    path.write_bytes(benchmark.synthetic_pdf(pages=2, outlines=0))
+    with open(str(path), 'rb') as fh:
+        (annots, outlines, _) = pdfannots.extract_annotations(fh, False)
+        printer = pdfannots.OrgPrinter(outlines, None, None)
+        expected = ''.join(label + body + '\n' for (label, body) in (
+            printer.format_annot(a, a.tagname) for a in annots))
+
+    response = pdfannots.serve_request({"path": str(path), "group": False})
+    assert response['org'] == expected
+
+
+def test_atomic_write_failure(tmp_path):
+    with pytest.raises(OSError) as excinfo:
+        with pdfannots.atomic_write(str(tmp_path / "missing" / "x.org")):
+            pass
+    assert excinfo.value.__context__ is None  # not hidden by a cleanup error
+
+    with pytest.raises(ValueError):
+        with pdfannots.atomic_write(str(tmp_path / "x.org")):
+            raise ValueError
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize("option,value,error", [
+    ("cols", 0, "cols must be an integer of at least 1"),
+    ("cols", True, "cols must be an integer of at least 1"),
+    ("wrap", "x", "wrap must be an integer or null"),
+    ("sections", "comments", "sections must be a list of strings"),
+    ("subtypes", ["Text", 1], "subtypes must be a list of strings or null"),
+    ("authors", "benchmark", "authors must be a list of strings or null"),
+    ("group", 0, "group must be true or false"),
+    ("printfilename", "yes", "printfilename must be true or false"),
+])
+def test_serve_option_types(option, value, error):
+    with pytest.raises(ValueError, match="^%s$" % error):
+        pdfannots.serve_request({"path": "doc.pdf", option: value})
+
+
+def test_delta_update_to_page():
+    data = benchmark.synthetic_pdf(pages=4, lines=10, annots=3)
+    doc = PDFDocument(PDFParser(io.BytesIO(data)))
+    page = list(PDFPage.create_pages(doc))[2]
+    annot = page.annots[0].objid
+    source = "<< /Type /Annot /Subtype /Text /Rect [36 36 56 56] " \
+        "/Contents (updated) >>"
+
+    newdata = append_update(data, {annot: source})
+    assert changed_pages(newdata, len(data)) == [2]
+
+
+def test_delta_update_to_font():
+    data = benchmark.synthetic_pdf(pages=4, lines=10, annots=3)
+    delta = pdfannots.Delta()
+    before = extract(data, delta)
+
+    # the update only replaces the font that every page refers to in its
+    # resources, which now decodes "e" as "x"
+    newdata = append_update(data, {
+        FONT: "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica "
+              "/Encoding << /Differences [101 /x] >> >>"})
+    assert changed_pages(newdata, len(data)) == [0, 1, 2, 3]
+
+    after = extract(newdata, delta)
+    assert after != before
+    assert after == extract(newdata)
+
+
+def test_interleaved_documents():
+    # both documents have their font as object 4, one Helvetica and the
+    # other embedded
+    data = benchmark.synthetic_pdf(pages=3, lines=10, annots=4, sticky=0)
+    other = benchmark.synthetic_pdf(pages=3, lines=10, annots=4, sticky=0,
+                                    seed=1, embed=True)
+    expected = extract(data)
+
+    (annots, _, _) = pdfannots.extract_annotations(io.BytesIO(data), False)
+    texts = [next(annots).gettext()]
+    extract(other)  # in full, while the first is under way
+    texts += [a.gettext() for a in annots]
+    assert texts == expected
+
+
+def corpus():
+    """Yields the data of a few documents, for comparing extraction paths."""
+    for seed in range(2):
+        yield benchmark.synthetic_pdf(pages=4, seed=seed, outlines=0)
+
+
+@pytest.mark.skipif(not pdfannots.have_numpy(), reason="requires NumPy")
+def test_numpy_engine():
+    for data in corpus():
+        assert extract(data, engine='numpy') == extract(data)
+
+
+def test_page_jobs(tmp_path):
+    for data in corpus():
+        path = tmp_path / "doc.pdf"
+        path.write_bytes(data)
+        assert extract(data, pagejobs=2, path=str(path)) == extract(data)
+
+
+def test_glyph_cache(tmp_path):
+    cache = pdfannots.GlyphCache(str(tmp_path), 1 << 30)
+    for data in corpus():
+        expected = extract(data)
+        assert extract(data, cache=cache) == expected  # cold
+        assert any(tmp_path.iterdir())
+        assert extract(data, cache=cache) == expected  # warm
+
+
+def test_restrict_layout():
+    # the last page of the second has an underline running on to the next
+    # column
+    for seed in range(2):
+        data = benchmark.synthetic_pdf(pages=9, seed=seed, outlines=0)
+        assert extract(data, restrict=True) == extract(data)
+
+
+def peak_memory(pages, max_memory):
+    """
+    Peak of the memory allocated while the annotations of a document of the
+    given number of pages are extracted, with pdfannots' max_memory.
+    """
+    # text markup in an embedded font, so that every page is laid out and
+    # the font loaded again after each trim
+    data = benchmark.synthetic_pdf(pages=pages, lines=8, annots=1, sticky=0,
+                                   outlines=0, embed=True)
+    gc.collect()  # else the peak depends on when garbage is next collected
+    tracemalloc.start()
+    try:
+        (annots, _, _) = pdfannots.extract_annotations(
+            io.BytesIO(data), False, max_memory=max_memory)
+        for _ in annots:
+            pass
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_max_memory_bounds_peak():
+    peak_memory(4, 1)  # loads what is kept for the life of the process
+
+    # a limit of 1 KiB is always exceeded, so caches are dropped after
+    # every page; what still grows is mostly pdfminer's table of the
+    # document's objects, by about a tenth, whereas without trimming the
+    # peak grows by over a quarter
+    small = peak_memory(4, 1)
+    large = peak_memory(40, 1)
+    assert large <= small * (1 + MEMORY_TOLERANCE)